@@ -18,19 +18,28 @@
 # Built-in
 from collections.abc import Callable
 from dataclasses import dataclass, field
-from functools import partial
 import os
 import shutil
 import subprocess
+from time import perf_counter
 
 # 3rd Party
-from PySide2.QtCore import QProcess
+from PySide2.QtCore import QProcess, QProcessEnvironment
 
 # External
 from haymaker.enums import ResultType
-from haymaker.log import log, Level
+from haymaker.log import counter, histogram, log, Level
 from haymaker.widgets import send_system_notification
 
+#----------------------------------------------------------------------------------------#
+#----------------------------------------------------------------------------- GLOBALS --#
+
+_process_exits = counter(
+    'haymaker_subprocess_exits_total', 'Finished subprocesses', labels=('name', 'exit_code')
+)
+_process_seconds = histogram(
+    'haymaker_subprocess_seconds', 'Duration of subprocesses', labels=('name',)
+)
 
 #----------------------------------------------------------------------------------------#
 #--------------------------------------------------------------------------- FUNCTIONS --#
@@ -72,6 +81,7 @@ class Process(object):
     exe: str
     args: [str]
     on_finish: Callable[[ProcessResult], None] = None
+    env: dict = None
 
     stdout: int = subprocess.PIPE
     stderr: int = subprocess.PIPE
@@ -79,6 +89,7 @@ class Process(object):
     is_finished: bool = field(default=False, init=False)
     results: (str, str) = field(default=None, init=False)
     _obj: QProcess = field(default=None, init=False)
+    _started: float = field(default=None, init=False)
 
     def run(self):
         """
@@ -88,8 +99,14 @@ class Process(object):
         :type: bool
         """
         self._obj = QProcess()
+        if self.env:
+            env = QProcessEnvironment.systemEnvironment()
+            for key, value in self.env.items():
+                env.insert(key, value)
+            self._obj.setProcessEnvironment(env)
         self._obj.start(self.exe, self.args)
-        self._obj.finished.connect(partial(self.finish, self._obj))
+        self._started = perf_counter()
+        self._obj.finished.connect(self.finish)
         started = self._obj.error() == QProcess.ProcessError.UnknownError
 
         # make sure the process is dead, if it failed to start
@@ -112,6 +129,9 @@ class Process(object):
         :return:
         """
         self.is_finished = True
+        _process_exits.inc(name=self.name, exit_code=exit_code)
+        if self._started is not None:
+            _process_seconds.observe(perf_counter() - self._started, name=self.name)
 
         # log finish event
         result, errors = self._get_result()
@@ -205,6 +225,6 @@ class AppExecuter(object):
 
         # check the process was started successfully
         if not started:
-            log(f'Failed to start process. Check {self.path_exe} exists.', Level.ERROR)
+            log(f'Failed to start process. Check {self.path_exe} exists.', level=Level.ERROR)
 
         return process, started
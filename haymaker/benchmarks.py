@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+#SETMODE 777
+
+#----------------------------------------------------------------------------------------#
+#------------------------------------------------------------------------------ HEADER --#
+
+"""
+:author:
+    Nick Maclean
+
+:synopsis:
+    Quick throughput checks for the hot paths in haymaker. These don't need Maya.
+
+    python -m haymaker.benchmarks [name ...]
+"""
+
+#----------------------------------------------------------------------------------------#
+#----------------------------------------------------------------------------- IMPORTS --#
+
+# Built-In
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+# Internal
+from haymaker.formula_manager import Disk, FormulaRepo
+from haymaker import log
+
+#----------------------------------------------------------------------------------------#
+#--------------------------------------------------------------------------- FUNCTIONS --#
+
+
+def _report(label: str, count: int, seconds: float):
+    print(f'  {label:<32} {count / seconds:>14,.0f} /s  ({seconds:.3f}s)')
+
+
+def benchmark_eval_many(count: int = 100_000):
+    """
+    FormulaRepo.eval per row (with and without the opt-in LRU) vs FormulaRepo.eval_many
+    for the same rows, and static formulas from their table vs evaluated.
+    """
+    print(f'eval vs eval_many, {count:,} rows of f_log')
+    rows = [{'user': f'user{i % 40}', 'name': f'shot{i}.log'} for i in range(count)]
+    columns = {
+        'user': [row['user'] for row in rows],
+        'name': [row['name'] for row in rows],
+    }
+
+    repo = FormulaRepo.load()
+    start = perf_counter()
+    for row in rows:
+        repo.eval('f_log', **row)
+    _report('eval (per call)', count, perf_counter() - start)
+
+    # every call is a hit, so this is the best the LRU can do
+    repo = FormulaRepo.load(cache_size=256)
+    row = rows[0]
+    start = perf_counter()
+    for _ in range(count):
+        repo.eval('f_log', **row)
+    _report('eval (per call, LRU hits)', count, perf_counter() - start)
+
+    repo = FormulaRepo.load()
+    start = perf_counter()
+    for _ in range(count):
+        repo.eval('f_log', **row)
+    _report('eval (per call, same row)', count, perf_counter() - start)
+
+    start = perf_counter()
+    for _ in repo.eval_many('f_log', rows):
+        pass
+    _report('eval_many (rows)', count, perf_counter() - start)
+
+    start = perf_counter()
+    for _ in repo.eval_many('f_log', columns):
+        pass
+    _report('eval_many (columns)', count, perf_counter() - start)
+
+    print(f'static formulas, {count:,} evals of f_asset_catalog')
+    start = perf_counter()
+    for _ in range(count):
+        repo.eval('f_asset_catalog')
+    _report('eval (static table)', count, perf_counter() - start)
+
+    start = perf_counter()
+    for _ in range(count):
+        repo._eval_formula('asset_catalog', {})
+    _report('eval (evaluated)', count, perf_counter() - start)
+
+
+def benchmark_startup(count: int = 30):
+    """
+    Cold json load vs the startup cache, in short-lived processes like mayabatch.
+    """
+    print(f'FormulaRepo.load in {count} new processes')
+    dir_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = (f'import sys; sys.path.insert(0, {dir_root!r}); '
+            f'from time import perf_counter; '
+            f'from haymaker.formula_manager import Disk, FormulaRepo; '
+            f'start = perf_counter(); '
+            f'FormulaRepo.load(use_cache={{use_cache}}).eval("d_logs"); '
+            f'print(perf_counter() - start)')
+
+    # warm the cache (and the OS' file cache) first
+    FormulaRepo.load()
+    for label, use_cache in (('json', False), ('startup cache', True)):
+        in_process = 0
+        start = perf_counter()
+        for _ in range(count):
+            output = subprocess.check_output(
+                [sys.executable, '-c', code.format(use_cache=use_cache)]
+            )
+            in_process += float(output)
+        total = perf_counter() - start
+        print(f'  {label:<16} {total / count * 1000:>8.2f} ms per process, '
+              f'{in_process / count * 1000:.3f} ms in load + first eval')
+
+
+def benchmark_resolve_variable(count: int = 20_000):
+    """
+    FormulaRepo._resolve_variable for every variable of formulas with 5-10 variables.
+    """
+    repo = FormulaRepo.load(cache_size=0, use_cache=False)
+    repo._add_formula('d_shot_dir', '|drive|/|code|/|disc|/|seq|/|shot|', 'benchmark')
+    repo._add_formula(
+        'f_shot_version',
+        '|config|/|d_logs|/|d_shot_dir|/|user|/|seq|_|shot|_|disc|.|version|.|ext|',
+        'benchmark'
+    )
+    kwargs = {
+        'user': 'nick', 'name': 'a.log', 'disc': 'ani', 'seq': 's01', 'shot': '010',
+        'version': '0001', 'ext': 'ma',
+    }
+
+    for name in ('d_shot_dir', 'f_shot_version'):
+        variables = repo._compiled[repo._remove_prefix(name)].variables
+        print(f'_resolve_variable, {name} ({len(variables)} variables) x {count:,}')
+        start = perf_counter()
+        for _ in range(count):
+            for variable in variables:
+                repo._resolve_variable(variable, **kwargs)
+        _report('variables', count * len(variables), perf_counter() - start)
+
+        # overriding a reserved variable forces a full evaluation
+        start = perf_counter()
+        for _ in range(count):
+            repo.eval(name, disk=Disk.CODE, **kwargs)
+        _report('eval (overridden disk)', count, perf_counter() - start)
+
+
+def benchmark_log_writer(count: int = 5_000):
+    """
+    Writing log lines with a flush + fsync per line vs the background log writer.
+    """
+    print(f'log file writes, {count:,} messages')
+    line = json.dumps({
+        'date': '2023-01-01 00-00-00', 'level': 'Info', 'message': 'updated file1 to a '
+        'user path (%USERPROFILE%/Box/Capstone_Uploads/tex.png)', 'trace': [],
+    }) + '\n'
+
+    with tempfile.TemporaryDirectory() as dir_temp:
+        path = os.path.join(dir_temp, 'fsync.log')
+        with open(path, 'w') as file:
+            start = perf_counter()
+            for _ in range(count):
+                file.write(line)
+                file.flush()
+                os.fsync(file.fileno())
+            _report('flush + fsync per message', count, perf_counter() - start)
+
+        writer = log._LogWriter(os.path.join(dir_temp, 'writer.log'))
+        start = perf_counter()
+        for _ in range(count):
+            writer.write(line)
+        _report('log writer (caller)', count, perf_counter() - start)
+        writer.close()
+        _report('log writer (until on disk)', count, perf_counter() - start)
+
+
+def benchmark_console(count: int = 20):
+    """
+    Console output of a long message (e.g. a traceback from mayabatch), wrapped and not.
+    """
+    message = ''.join(f'  File "script.py", line {i}, in func\n{"x" * 100}\n'
+                      for i in range(1000))
+    print(f'console output, {count} messages of {len(message):,} characters')
+
+    stdout = sys.stdout
+    for label, width in (('wrapped (120)', 120), ('no wrap', None)):
+        sys.stdout = io.StringIO()
+        start = perf_counter()
+        for _ in range(count):
+            log._log_to_console(message, log.Level.INFO, [], width)
+        seconds = perf_counter() - start
+        sys.stdout = stdout
+        _report(label, count, seconds)
+
+
+BENCHMARKS = {
+    'eval_many': benchmark_eval_many,
+    'startup': benchmark_startup,
+    'resolve_variable': benchmark_resolve_variable,
+    'log_writer': benchmark_log_writer,
+    'console': benchmark_console,
+}
+
+
+#----------------------------------------------------------------------------------------#
+#-------------------------------------------------------------------------------- MAIN --#
+
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
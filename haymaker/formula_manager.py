@@ -16,9 +16,15 @@
 #----------------------------------------------------------------------------- IMPORTS --#
 
 # Built-In
+from collections import OrderedDict
 from enum import Enum
+import hashlib
 import json
 import os
+import pickle
+import re
+import threading
+from time import monotonic
 
 # Internal
 # from haymaker.log import log, Level
@@ -27,19 +33,36 @@ import os
 #--------------------------------------------------------------------------- FUNCTIONS --#
 
 
-_repo: 'FormulaRepo' = None
-def eval_formula(formula_name: str, expand_user=True, **kwargs) -> str:
-    # lazy load formula repo
-    global _repo
-    if not _repo:
-        _repo = FormulaRepo.load()
+def _get_repo() -> 'FormulaRepo':
+    # lazy load formula repo, and pick up changes to the formula files
+    return _handle.get()
+
 
-    path = _repo.eval(formula_name, **kwargs)
+def eval_formula(formula_name: str, expand_user=True, **kwargs) -> str:
+    path = _get_repo().eval(formula_name, **kwargs)
     if expand_user:
         path = os.path.expanduser(path)
     return path
 
 
+def glob_formula(formula_name: str, **kwargs):
+    """
+    Finds existing paths on disk that match a formula. See FormulaRepo.glob.
+
+    :returns: generator of (path, {variable: value})
+    """
+    return _get_repo().glob(formula_name, **kwargs)
+
+
+def match_formula(path: str) -> (str, dict):
+    """
+    Finds the formula that would evaluate to this path. See FormulaRepo.match.
+
+    :returns: (formula name, {variable: value}) or None
+    """
+    return _get_repo().match(path)
+
+
 def _read_json(path: str, verbose: bool = True):
     try:
         with open(os.path.expanduser(path), 'r') as file:
@@ -56,6 +79,119 @@ def _read_json(path: str, verbose: bool = True):
     return data
 
 
+_HOME = os.path.expanduser('~').replace('\\', '/')
+
+
+def _glob_segments(directory: str, segments: list, i: int, variables: dict, patterns: dict):
+    # collect literal folders, without touching the disk
+    while i < len(segments) - 1 and not any(isinstance(part, _Variable) for part in segments[i]):
+        directory += '/' + ''.join(segments[i])
+        i += 1
+
+    # variables that were already found in a parent folder have to match again
+    segment = segments[i]
+    key = (i, tuple(sorted(variables.items())))
+    if not (pattern := patterns.get(key)):
+        pattern = ''
+        groups = set()
+        for part in segment:
+            if not isinstance(part, _Variable):
+                pattern += re.escape(part)
+            elif part in variables:
+                pattern += re.escape(variables[part])
+            elif part in groups:
+                pattern += f'(?P={part})'
+            else:
+                groups.add(part)
+                pattern += f'(?P<{part}>.+?)'
+        pattern = patterns[key] = re.compile(pattern)
+
+    is_last = i == len(segments) - 1
+    # don't keep the folder open while the caller works through the results
+    try:
+        with os.scandir(directory) as it:
+            entries = [entry for entry in it]
+    except OSError:
+        return
+
+    for entry in entries:
+        if not (match := pattern.fullmatch(entry.name)):
+            continue
+
+        found = {**variables, **match.groupdict()}
+        path = f'{directory}/{entry.name}'
+        if is_last:
+            yield path, found
+        elif entry.is_dir():
+            yield from _glob_segments(path, segments, i + 1, found, patterns)
+
+
+def _get_layer_paths(layers: list) -> list:
+    # layer paths can only use reserved variables, formulas aren't loaded yet
+    resolver = FormulaRepo(cache_size=0)
+    paths = []
+    for layer, path in layers:
+        # default to ./formulas.json
+        if not path:
+            path = os.path.join(os.path.dirname(__file__), 'formulas.json')
+        path = os.path.abspath(os.path.expanduser(resolver._eval(path)))
+        paths.append((layer, path))
+    return paths
+
+
+def _get_startup_cache_key(paths: list) -> tuple:
+    # the cache is only valid for the exact versions of the json it was built from,
+    # including layers that didn't exist at the time, and of this module
+    key = []
+    for layer, path in [(None, os.path.abspath(__file__))] + paths:
+        try:
+            stat = os.stat(path)
+            key.append((layer, path, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            key.append((layer, path, None, None))
+    return tuple(key)
+
+
+def _get_startup_cache_path(key: tuple) -> str:
+    name = hashlib.md5(repr([path for _, path, _, _ in key[1:]]).encode()).hexdigest()
+    return os.path.join(os.path.expanduser(FormulaRepo.DIR_STARTUP_CACHE), f'{name}.pickle')
+
+
+def _read_startup_cache(key: tuple) -> 'FormulaRepo':
+    try:
+        with open(_get_startup_cache_path(key), 'rb') as file:
+            cached_key, repo = pickle.loads(file.read())
+    except Exception:
+        # missing, from an older version of this module, or otherwise unreadable
+        return None
+
+    return repo if cached_key == key else None
+
+
+def _write_startup_cache(key: tuple, repo: 'FormulaRepo'):
+    # write to a temp file first, so other processes never read half a cache
+    path = _get_startup_cache_path(key)
+    path_temp = f'{path}.{os.getpid()}'
+    try:
+        data = pickle.dumps((key, repo), pickle.HIGHEST_PROTOCOL)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path_temp, 'wb') as file:
+            file.write(data)
+        os.replace(path_temp, path)
+    except Exception:
+        # unwritable, or the repo can't be pickled (e.g. this module was imported under
+        # another name). the cache is only an optimization, loading still works
+        try:
+            os.remove(path_temp)
+        except OSError:
+            pass
+
+
+def _freeze_kwargs(kwargs: dict) -> tuple:
+    # kwarg names are unique, so sorting never has to compare the values
+    return tuple(sorted(kwargs.items()))
+
+
 #----------------------------------------------------------------------------------------#
 #------------------------------------------------------------------------------- ENUMS --#
 
@@ -107,12 +243,82 @@ class FormulaNotFoundError(FormulaException): pass
 class FormulaArgumentError(FormulaException): pass
 class FormulaDuplicateError(FormulaException): pass
 class FormulaEvaluationError(FormulaException): pass
+class FormulaCycleError(FormulaException): pass
 
 
 #----------------------------------------------------------------------------------------#
 #----------------------------------------------------------------------------- CLASSES --#
 
 
+class _Variable(str):
+    """
+    Marks a variable name inside a tokenized path segment.
+    """
+    __slots__ = ()
+
+
+class CompiledFormula(object):
+    """
+    A formula that has been split into its literal text and variable slots, so it can be
+    evaluated without being parsed again. Literals and variables interleave:
+    literals[0], variables[0], literals[1], ..., literals[-1].
+    """
+    __slots__ = ('source', 'literals', 'variables', '_template')
+
+    def __init__(self, source: str, literals: tuple, variables: tuple):
+        self.source = source
+        self.literals = literals
+        self.variables = variables
+
+        # %-style template, so rendering is a single C-level format
+        self._template = '%s'.join(literal.replace('%', '%%') for literal in literals)
+
+    @classmethod
+    def compile(cls, formula: str) -> 'CompiledFormula':
+        """
+        Tokenizes a formula. Splitting on | leaves literals at even indices and variable
+        names at odd indices.
+        """
+        tokens = formula.split('|')
+        if len(tokens) % 2 == 0:
+            raise FormulaEvaluationError(f"Missing closing '|' in {formula}")
+        return cls(formula, tuple(tokens[0::2]), tuple(tokens[1::2]))
+
+    @classmethod
+    def from_parts(cls, literals, variables) -> 'CompiledFormula':
+        """
+        Builds a formula from already tokenized literals and variables.
+        """
+        source = literals[0] + ''.join(
+            f'|{variable}|{literal}' for variable, literal in zip(variables, literals[1:])
+        )
+        return cls(source, tuple(literals), tuple(variables))
+
+    def bind(self, values: dict) -> 'CompiledFormula':
+        """
+        Replaces the variables that have a value with literal text. Values are used as
+        is, they should already be resolved.
+        """
+        literals = [self.literals[0]]
+        variables = []
+        for variable, literal in zip(self.variables, self.literals[1:]):
+            if variable in values:
+                literals[-1] += values[variable] + literal
+            else:
+                variables.append(variable)
+                literals.append(literal)
+        return CompiledFormula.from_parts(literals, variables)
+
+    def render(self, values) -> str:
+        """
+        Fills the variable slots with the provided values (in the order of variables).
+        """
+        return self._template % tuple(values)
+
+    def __repr__(self):
+        return f'<CompiledFormula {self.source!r}>'
+
+
 class FormulaRepo(object):
     """
     Container for runtime generated and evaluated file path formulas. Formulas can build
@@ -122,10 +328,48 @@ class FormulaRepo(object):
     RESERVED_KEYWORDS = [
         Drive, Disk
     ]
+    # the LRU only pays off when rendering a formula costs more than hashing its kwargs,
+    # which compiled formulas rarely do, so it's off unless a repo asks for it
+    CACHE_SIZE = 0
+    DIR_STARTUP_CACHE = '~/.haymaker/cache'
+    LAYERS = [
+        ('studio', None),
+        ('show', '|config|/formulas.json'),
+        ('user', '~/.haymaker/formulas.json'),
+    ]
 
-    def __init__(self):
+    def __init__(self, cache_size: int = None):
         self.formulas = {}
         self.formula_prefixes = []
+        self.formula_layers = {}
+        self.layers = []
+        self.path = None
+
+        # lookup tables for variable names
+        self._prefixes = frozenset()
+        self._reserved = self._index_reserved()
+        self._resolvers = None
+
+        # formulas (and reserved/kwarg values with variables) tokenized ahead of time
+        self._compiled = {}
+        self._compiled_values = {}
+
+        # evaluation results. formulas that only use reserved variables are kept forever,
+        # everything else can go through a LRU keyed by the formula name and kwargs (see
+        # CACHE_SIZE)
+        self.cache_size = self.CACHE_SIZE if cache_size is None else cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._cache = OrderedDict()
+        self._static = {}
+
+        # derived from the formulas when they are loaded (see _link)
+        self.formula_graph = None
+        self.formula_order = None
+        self._dependencies = {}
+        self._expanded = {}
+        self._overrides = {}
+        self._matcher = None
 
     def eval(self, formula_name: str, **kwargs) -> str:
         """
@@ -145,40 +389,348 @@ class FormulaRepo(object):
         """
         # get formula
         formula_name = self._remove_prefix(formula_name)
+        if formula_name not in self._compiled:
+            raise FormulaNotFoundError(f'Could not find a formula for {formula_name}.')
+        if self.formula_order is None:
+            self._link()
+
+        # the result of a formula without free variables can only change if kwargs
+        # override one of the reserved variables or formulas it is built from
+        dependencies, is_static = self._dependencies[formula_name]
+        if is_static and dependencies.isdisjoint(kwargs):
+            try:
+                value = self._static[formula_name]
+                self.cache_hits += 1
+            except KeyError:
+                self.cache_misses += 1
+                value = self._static[formula_name] = self._eval_formula(formula_name, kwargs)
+            return value
+
+        if not self.cache_size:
+            return self._eval_formula(formula_name, kwargs)
+
+        # kwargs that can't be hashed can't be cached either
         try:
-            formula = self.formulas[formula_name]
+            key = (formula_name, _freeze_kwargs(kwargs))
+            value = self._cache[key]
+        except TypeError:
+            return self._eval_formula(formula_name, kwargs)
         except KeyError:
+            self.cache_misses += 1
+            value = self._cache[key] = self._eval_formula(formula_name, kwargs)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return value
+
+        self.cache_hits += 1
+        try:
+            self._cache.move_to_end(key)
+        except KeyError:
+            # another thread evicted it in the meantime
+            pass
+        return value
+
+    def eval_many(self, formula_name: str, rows, **kwargs):
+        """
+        Evaluates a formula for many sets of variables. Everything that does not change
+        between rows (reserved keywords, nested formulas, and kwargs) is resolved once,
+        so each row only has to fill in its own variables. Results are not cached.
+
+        for path in repo.eval_many('f_log', [{'user': 'a', 'name': 'x.log'}, ...]):
+            ...
+
+        :param formula_name: the name of the formula you would like to evaluate.
+        :param rows: an iterable of kwarg dicts, or a dict of columns
+                     ({variable: [value, ...]}, all the same length).
+        :param kwargs: named variables shared by every row.
+
+        :returns: generator of resolved formulas, in the order of rows.
+        """
+        formula_name = self._remove_prefix(formula_name)
+        if formula_name not in self._compiled:
+            raise FormulaNotFoundError(f'Could not find a formula for {formula_name}.')
+
+        if self.formula_order is None:
+            self._link()
+
+        # kwargs that override a reserved variable or formula change the whole expansion,
+        # and shared values with variables of their own could depend on the rows. fall
+        # back to evaluating every row on its own
+        expanded = self._expanded[formula_name]
+        overrides = self._overrides[formula_name]
+        shared = {
+            variable: kwargs[variable]
+            for variable in expanded.variables
+            if variable in kwargs
+        }
+        if not overrides.isdisjoint(kwargs) or any('|' in v for v in shared.values()):
+            yield from self._eval_rows(formula_name, rows, kwargs)
+            return
+
+        # inline the shared kwargs. rows that set an override or a shared kwarg (rows
+        # win over kwargs) are evaluated on their own
+        formula = expanded.bind(shared)
+        variables = formula.variables
+        render = formula.render
+        fixed = overrides.union(kwargs)
+
+        # columns can be zipped directly into the template
+        if isinstance(rows, dict):
+            if not fixed.isdisjoint(rows):
+                yield from self._eval_rows(formula_name, rows, kwargs)
+                return
+            try:
+                columns = [rows[variable] for variable in variables]
+            except KeyError as e:
+                raise FormulaArgumentError(f'eval() is missing an argument for {e.args[0]}.')
+
+            for i, values in enumerate(zip(*columns)):
+                path = render(values)
+                # a value had variables of its own, which can come from any column
+                if '|' in path:
+                    row = {name: column[i] for name, column in rows.items()}
+                    path = self.eval(formula_name, **{**kwargs, **row})
+                yield path
+            return
+
+        for row in rows:
+            if not fixed.isdisjoint(row):
+                yield self.eval(formula_name, **{**kwargs, **row})
+                continue
+            try:
+                path = render([row[variable] for variable in variables])
+            except KeyError as e:
+                raise FormulaArgumentError(f'eval() is missing an argument for {e.args[0]}.')
+            if '|' in path:
+                path = self.eval(formula_name, **{**kwargs, **row})
+            yield path
+
+    def _eval_rows(self, formula_name, rows, kwargs):
+        if isinstance(rows, dict):
+            names = list(rows)
+            rows = (dict(zip(names, values)) for values in zip(*rows.values()))
+        for row in rows:
+            yield self.eval(formula_name, **{**kwargs, **row})
+
+    def cache_info(self) -> dict:
+        """
+        Hit/miss counters and current size of the evaluation cache.
+        """
+        return {
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'size': len(self._cache) + len(self._static),
+            'max_size': self.cache_size,
+        }
+
+    def clear_cache(self):
+        """
+        Forgets all cached evaluation results. This happens automatically when the repo
+        is reloaded or a formula is added.
+        """
+        self._cache.clear()
+        self._static.clear()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def match(self, path: str) -> (str, dict):
+        """
+        Reverse of eval. Finds the formula that would evaluate to the provided path and
+        the variables it would need. Formulas are matched with their default reserved
+        variables, and when several formulas could produce the path the most specific
+        (most literal text, fewest variables) wins. A variable matches text within a
+        single folder or file name.
+            - "~/Box/Capstone_Uploads/13_Tech/haymaker/logs/nick/a.log" would match
+              ('log', {'user': 'nick', 'name': 'a.log'}).
+
+        :param path: a file path, using / or \\ and either ~ or the user's home folder.
+
+        :returns: (formula name, {variable: value}) or None if no formula matches.
+        """
+        if not self._matcher:
+            self._matcher = self._build_matcher()
+        pattern, groups = self._matcher
+
+        # formulas are matched against ~ paths
+        path = path.replace('\\', '/')
+        if path.startswith('%USERPROFILE%'):
+            path = '~' + path[len('%USERPROFILE%'):]
+        elif path.startswith(_HOME) and path[len(_HOME):len(_HOME)+1] in ('', '/'):
+            path = '~' + path[len(_HOME):]
+
+        if not (match := pattern.fullmatch(path)):
+            return None
+        formula_name, variables = groups[match.lastgroup]
+        return formula_name, {
+            variable: match.group(group)
+            for group, variable in variables
+        }
+
+    def glob(self, formula_name: str, **kwargs):
+        """
+        Finds the files and folders on disk that match a formula, where variables
+        without a kwarg can be anything. Only the folders the formula allows are listed,
+        so it is much cheaper than walking the whole tree. A variable matches text within
+        a single folder or file name.
+
+        for path, variables in repo.glob('f_log', user='nick'):
+            print(path, variables['name'])
+
+        :param formula_name: the name of the formula you would like to search for.
+        :param kwargs: named variables that can be used during evaluation.
+
+        :returns: generator of (path, {variable: value}) for the unbound variables.
+        """
+        formula_name = self._remove_prefix(formula_name)
+        if formula_name not in self._compiled:
             raise FormulaNotFoundError(f'Could not find a formula for {formula_name}.')
-        return self._eval(formula, **kwargs)
+        if self.formula_order is None:
+            self._link()
+
+        if kwargs:
+            formula = self._expand_formula(self._compiled[formula_name], **kwargs)
+        else:
+            formula = self._expanded[formula_name]
+
+        # split into folders, each being a list of literals and variable names
+        segments = [[]]
+        for i, literal in enumerate(formula.literals):
+            if i:
+                segments[-1].append(_Variable(formula.variables[i-1]))
+            folders = literal.split('/')
+            if folders[0]:
+                segments[-1].append(folders[0])
+            segments.extend([folder] if folder else [] for folder in folders[1:])
+
+        # folders before the first variable don't need to be searched
+        for i, segment in enumerate(segments):
+            if any(isinstance(part, _Variable) for part in segment):
+                break
+        else:
+            i = len(segments)
+        root = '/'.join(''.join(segment) for segment in segments[:i])
+        root = os.path.expanduser(root).replace('\\', '/')
+
+        if i == len(segments):
+            if os.path.exists(root):
+                yield root, {}
+            return
+        yield from _glob_segments(root, segments, i, {}, {})
+
+    def reload(self):
+        """
+        Re-reads the formulas from the files this repo was loaded from.
+        """
+        repo = FormulaRepo.load_layers(self.layers, self.cache_size)
+        if not repo:
+            raise RuntimeError(f'Unable to reload formulas from {self.path}.')
+        self.__dict__.update(repo.__dict__)
 
     @staticmethod
-    def load(path: str = None):
+    def load(path: str = None, cache_size: int = None, use_cache: bool = True):
         """
-        Load a FormulaRepo from json. It will default to ./formulas.json.
+        Load a FormulaRepo from json. It will default to ./formulas.json. Formulas are
+        compiled and linked as they are loaded, so a malformed or circular formula is
+        reported here instead of the first time it is evaluated.
+
+        The compiled repo is also saved to a startup cache (see DIR_STARTUP_CACHE), so
+        following loads of the same, unchanged json (every Maya session and mayabatch
+        process) can skip parsing and compiling completely.
         """
         # default to ./formulas.json
         if not path or not os.path.isfile(path):
-            path = os.path.dirname(__file__)
-            path = os.path.join(path, 'formulas.json')
+            path = None
+        return FormulaRepo.load_layers([('studio', path)], cache_size, use_cache)
+
+    @staticmethod
+    def load_layers(layers: list = None, cache_size: int = None, use_cache: bool = True):
+        """
+        Load a FormulaRepo from several json files, layered on top of each other. Each
+        layer can override the formulas of the layers before it, and they are all merged
+        into one repo, so evaluating is no slower than with a single file. Defaults to
+        FormulaRepo.LAYERS (studio, show, user).
+
+        Only the first layer is required, the rest are skipped if they don't exist. A
+        layer's path can use reserved variables, e.g. "|config|/formulas.json", and a
+        path of None is ./formulas.json. See get_formula_layer to find which layer a
+        formula came from.
+
+        :param layers: [(layer name, path to json), ...] from lowest to highest priority.
+        """
+        if layers is None:
+            layers = FormulaRepo.LAYERS
+        paths = _get_layer_paths(layers)
 
-        # read and file
-        config_data = _read_json(path)
-        if not config_data:
-            raise RuntimeError('Unable to read a formulas.json.')
+        if use_cache:
+            key = _get_startup_cache_key(paths)
+            if repo := _read_startup_cache(key):
+                if cache_size is not None:
+                    repo.cache_size = cache_size
+                return repo
 
         # create an instance of the repo with this data
-        repo = FormulaRepo()
-        try:
-            repo.formula_prefixes = config_data['formula_prefixes']
-            for formula in config_data['formulas']:
-                repo._add_formula(formula, config_data['formulas'][formula])
-        except KeyError:
-            # log(f'{path} seems to be missing formula data.', level=Level.WARN)
-            return None
+        repo = FormulaRepo(cache_size)
+        repo.path = paths[0][1]
+        repo.layers = layers
+        for i, (layer, path) in enumerate(paths):
+            # read and file
+            config_data = _read_json(path, verbose=not i) if os.path.isfile(path) else None
+            if not config_data:
+                if not i:
+                    raise RuntimeError('Unable to read a formulas.json.')
+                continue
+
+            # override layers can rely on the prefixes of the layers before them
+            try:
+                if i:
+                    prefixes = config_data.get('formula_prefixes', [])
+                else:
+                    prefixes = config_data['formula_prefixes']
+                for prefix in prefixes:
+                    repo._add_prefix(prefix)
+                for formula in config_data['formulas']:
+                    repo._add_formula(formula, config_data['formulas'][formula], layer)
+            except KeyError:
+                # log(f'{path} seems to be missing formula data.', level=Level.WARN)
+                return None
+
+        # report circular formulas now, instead of on eval
+        repo._link()
+
+        if use_cache:
+            _write_startup_cache(key, repo)
 
         # log(f'Read formulas from {path}')
         return repo
 
+    def get_formula_layer(self, formula_name: str) -> str:
+        """
+        Finds the name of the layer that the formula with this key was loaded from.
+        """
+        return self.formula_layers.get(self._remove_prefix(formula_name))
+
+    def get_formula_sources(self, formula_name: str) -> dict:
+        """
+        Finds the layer of the formula with this key, and of every formula it is built
+        from.
+
+        :returns: {formula name: layer name}, dependencies come first.
+        """
+        formula_name = self._remove_prefix(formula_name)
+        if formula_name not in self._compiled:
+            raise FormulaNotFoundError(f'Could not find a formula for {formula_name}.')
+        if self.formula_order is None:
+            self._link()
+
+        sources = {}
+        pending = [formula_name]
+        while pending:
+            name = pending.pop()
+            if name not in sources:
+                sources[name] = self.formula_layers.get(name)
+                pending.extend(self.formula_graph[name])
+        return {name: sources[name] for name in self.formula_order if name in sources}
+
     def get_formula(self, formula_name: str):
         """
         Safely finds the formula with this key.
@@ -189,71 +741,343 @@ class FormulaRepo(object):
         except KeyError:
             return None
 
-    def _eval(self, formula: str, **kwargs):
-        # replace variables as necessary
-        resolved = ""
-        variable = None
-        for c in formula:
-            # start/stop variable evaluation
-            if c == '|':
-                # variable name is starting
-                if variable is None:
-                    variable = ""
-                # variable name is done
-                # evaluate the variable
-                else:
-                    resolved_variable = self._resolve_variable(variable, **kwargs)
-                    resolved += self._eval(resolved_variable, **kwargs)
-                    variable = None
+    def _eval_formula(self, formula_name: str, kwargs: dict) -> str:
+        # kwargs that override an inlined reserved variable or formula need the formula
+        # to be evaluated from scratch
+        if not self._overrides[formula_name].isdisjoint(kwargs):
+            return self._eval(self._compiled[formula_name], **kwargs)
 
-                continue
+        # otherwise, only the free variables are left to fill in
+        expanded = self._expanded[formula_name]
+        try:
+            values = [kwargs[variable] for variable in expanded.variables]
+        except KeyError as e:
+            raise FormulaArgumentError(f'eval() is missing an argument for {e.args[0]}.')
+        return expanded.render([
+            self._eval(value, **kwargs) if '|' in value else value
+            for value in values
+        ])
 
-            # collect variable name or non-variable characters
-            if variable is None:
-                resolved += c
-            else:
-                variable += c
+    def _eval(self, formula, **kwargs) -> str:
+        # values from kwargs and reserved keywords are plain strings, and only need to be
+        # compiled when they contain variables
+        if not isinstance(formula, CompiledFormula):
+            if '|' not in formula:
+                return formula
+            formula = self._compile_value(formula)
 
-        if variable is not None:
-            raise FormulaEvaluationError(f"Missing closing '|' in {formula}")
+        # replace variables as necessary
+        return formula.render([
+            self._eval(self._resolve_variable(variable, **kwargs), **kwargs)
+            for variable in formula.variables
+        ])
 
-        return resolved
+    def _compile_value(self, value: str) -> CompiledFormula:
+        try:
+            return self._compiled_values[value]
+        except KeyError:
+            compiled = self._compiled_values[value] = CompiledFormula.compile(value)
+            return compiled
 
     def _resolve_variable(self, variable, **kwargs):
+        if self._resolvers is None:
+            self._resolvers = self._index_resolvers()
+        resolver = self._resolvers.get(variable)
+
         # check keywords
-        for keyword in self.RESERVED_KEYWORDS:
-            if value := keyword.try_to_resolve(variable, **kwargs):
-                return value
+        if resolver.__class__ is tuple:
+            keyword, value = resolver
+            # allow override from kwargs
+            if keyword.DEFAULT.value in kwargs:
+                return kwargs[keyword.DEFAULT.value].value
+            return value
 
         # check kwargs
         if variable in kwargs:
             return kwargs[variable]
 
         # check formulas
-        if formula := self.get_formula(variable):
-            return self._eval(formula, **kwargs)
+        if resolver:
+            return resolver
 
         # unknown variable
         raise FormulaArgumentError(
             f'eval() is missing an argument for {variable}.'
         )
 
+    def _link(self):
+        """
+        Builds the dependency graph between formulas and walks it in topological order,
+        so every formula can be expanded from its (already expanded) dependencies.
+        Reserved variables and nested formulas are inlined ahead of time, leaving only
+        the variables that have to come from kwargs for eval.
+        """
+        graph = {}
+        for name, formula in self._compiled.items():
+            graph[name] = []
+            for variable in formula.variables:
+                nested = self._remove_prefix(variable)
+                if not self._find_reserved_keyword(variable) and nested in self._compiled:
+                    graph[name].append(nested)
+
+        # depth first, dependencies end up before their dependents
+        order = []
+        visited = set()
+        path = []
+
+        def visit(name):
+            if name in visited:
+                return
+            if name in path:
+                cycle = ' -> '.join(path[path.index(name):] + [name])
+                raise FormulaCycleError(f'Formulas depend on each other: {cycle}')
+
+            path.append(name)
+            for nested in graph[name]:
+                visit(nested)
+            path.pop()
+
+            visited.add(name)
+            order.append(name)
+
+        for name in graph:
+            visit(name)
+
+        for name in order:
+            formula = self._compiled[name]
+            dependencies = self._dependencies[name] = self._collect_dependencies(formula)
+            expanded = self._expanded[name] = self._expand_formula(formula)
+            self._overrides[name] = dependencies[0].difference(expanded.variables)
+
+        self.formula_graph = graph
+        self.formula_order = order
+
+    def _collect_dependencies(self, formula: CompiledFormula) -> (frozenset, bool):
+        dependencies = set(formula.variables)
+        is_static = True
+        for variable in formula.variables:
+            # reserved variables can be overridden with any member of their enum
+            if keyword := self._find_reserved_keyword(variable):
+                dependencies.add(keyword.DEFAULT.value)
+                for member in keyword:
+                    if '|' in member.value:
+                        nested, _ = self._collect_dependencies(
+                            self._compile_value(member.value)
+                        )
+                        dependencies.update(nested)
+                continue
+
+            # nested formulas
+            name = self._remove_prefix(variable)
+            if name in self._compiled:
+                nested, nested_is_static = self._dependencies[name]
+                dependencies.update(nested)
+                is_static = is_static and nested_is_static
+                continue
+
+            # must come from kwargs
+            is_static = False
+
+        return frozenset(dependencies), is_static
+
+    def _expand_formula(self, formula: CompiledFormula, **kwargs) -> CompiledFormula:
+        # inline everything that can be resolved, leave the rest as variables
+        literals = [formula.literals[0]]
+        variables = []
+        for variable, literal in zip(formula.variables, formula.literals[1:]):
+            try:
+                nested = self._resolve_variable(variable, **kwargs)
+            except FormulaArgumentError:
+                variables.append(variable)
+                literals.append(literal)
+                continue
+
+            if not isinstance(nested, CompiledFormula):
+                nested = self._expand_formula(self._compile_value(nested), **kwargs)
+            elif kwargs:
+                nested = self._expand_formula(nested, **kwargs)
+            else:
+                nested = self._expanded[self._remove_prefix(variable)]
+            literals[-1] += nested.literals[0]
+            variables.extend(nested.variables)
+            literals.extend(nested.literals[1:])
+            literals[-1] += literal
+
+        return CompiledFormula.from_parts(literals, variables)
+
+    def _build_matcher(self) -> (re.Pattern, dict):
+        if self.formula_order is None:
+            self._link()
+
+        # the most specific formulas are tried first
+        expanded = list(self._expanded.items())
+        expanded.sort(key=lambda item: (
+            -sum(len(literal) for literal in item[1].literals), len(item[1].variables)
+        ))
+
+        alternatives = []
+        groups = {}
+        for i, (name, formula) in enumerate(expanded):
+            pattern = re.escape(formula.literals[0])
+            variables = {}
+            for variable, literal in zip(formula.variables, formula.literals[1:]):
+                # repeated variables must match the same text
+                if variable in variables:
+                    pattern += f'(?P={variables[variable]})'
+                else:
+                    group = variables[variable] = f'f{i}v{len(variables)}'
+                    pattern += f'(?P<{group}>[^/]+?)'
+                pattern += re.escape(literal)
+
+            # the outer group of the matched formula is always the last to close
+            alternatives.append(f'(?P<f{i}>{pattern})')
+            groups[f'f{i}'] = (name, [(group, variable) for variable, group in variables.items()])
+
+        return re.compile('|'.join(alternatives)), groups
+
+    def _find_reserved_keyword(self, variable):
+        if reserved := self._reserved.get(variable):
+            return reserved[0]
+        return None
+
+    def _index_reserved(self) -> dict:
+        """
+        Maps every reserved variable name to its ReservedVariable and default value, in
+        the same order ReservedVariable.try_to_resolve would find them.
+        """
+        reserved = {}
+        for keyword in reversed(self.RESERVED_KEYWORDS):
+            for member in reversed(list(keyword)[1:]):
+                reserved[member.name.lower()] = (keyword, member.value)
+            reserved[keyword.DEFAULT.value] = (keyword, keyword.get_default().value)
+        return reserved
+
+    def _index_resolvers(self) -> dict:
+        """
+        Maps every variable name that can be resolved without kwargs to either a
+        (ReservedVariable, default value) tuple or a CompiledFormula. Formulas are
+        listed with and without each prefix.
+        """
+        resolvers = {}
+        for name, formula in self._compiled.items():
+            resolvers[name] = formula
+            for prefix in self.formula_prefixes:
+                resolvers[f'{prefix}_{name}'] = formula
+
+        # reserved variables take priority
+        resolvers.update(self._reserved)
+        return resolvers
+
+    def _add_prefix(self, prefix: str):
+        if prefix not in self.formula_prefixes:
+            self.formula_prefixes.append(prefix)
+            self._prefixes = frozenset(self.formula_prefixes)
+            self._resolvers = None
+
     def _remove_prefix(self, s):
-        for prefix in self.formula_prefixes:
-            if s.startswith(prefix):
-                return s[len(prefix)+1:]
+        prefix, separator, name = s.partition('_')
+        if separator and prefix in self._prefixes:
+            return name
         return s
 
-    def _add_formula(self, key: str, formula: str):
+    def _add_formula(self, key: str, formula: str, layer: str = None):
+        # formulas can only be overridden by a later layer
         key = self._remove_prefix(key)
-        if key in self.formulas:
+        if key in self.formulas and self.formula_layers.get(key) == layer:
             raise FormulaDuplicateError(f'The {key} formula already exists.')
+        self._compiled[key] = CompiledFormula.compile(formula)
         self.formulas[key] = formula
+        self.formula_layers[key] = layer
+
+        # new formulas can change how other formulas resolve
+        self._invalidate()
+
+    def _invalidate(self):
+        self._resolvers = None
+        self.formula_graph = None
+        self.formula_order = None
+        self._dependencies = {}
+        self._expanded = {}
+        self._overrides = {}
+        self._matcher = None
+        self.clear_cache()
+
+    def __getstate__(self):
+        # evaluation results and the path matcher are rebuilt on demand
+        state = self.__dict__.copy()
+        state.update({
+            'cache_hits': 0,
+            'cache_misses': 0,
+            '_cache': OrderedDict(),
+            '_static': {},
+            '_matcher': None,
+        })
+        return state
 
     def __str__(self):
         return f'<FormulaRepo {self.__dict__}>'
 
 
+class FormulaRepoHandle(object):
+    """
+    Shares a FormulaRepo between threads and keeps it up to date with its json files.
+    The files are stat'ed at most once every check_interval seconds, and when they have
+    changed a new repo is loaded and swapped in. Threads that are evaluating with the
+    previous repo can keep using it.
+    """
+    CHECK_INTERVAL = 2.0
+
+    def __init__(self, layers: list = None, check_interval: float = None):
+        self.layers = layers
+        self.check_interval = self.CHECK_INTERVAL if check_interval is None else check_interval
+
+        self._repo = None
+        self._paths = None
+        self._key = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def get(self) -> FormulaRepo:
+        """
+        Gets the current repo, loading or reloading it if necessary.
+        """
+        # cheap path, no lock
+        repo = self._repo
+        if repo is not None and monotonic() - self._checked < self.check_interval:
+            return repo
+
+        with self._lock:
+            # another thread may have checked while we were waiting
+            if self._repo is not None and monotonic() - self._checked < self.check_interval:
+                return self._repo
+
+            if self._paths is None:
+                self._paths = _get_layer_paths(
+                    FormulaRepo.LAYERS if self.layers is None else self.layers
+                )
+            key = _get_startup_cache_key(self._paths)
+            if key != self._key:
+                self._swap(key)
+            self._checked = monotonic()
+            return self._repo
+
+    def _swap(self, key: tuple):
+        try:
+            repo = FormulaRepo.load_layers(self.layers)
+        except Exception:
+            # keep the formulas we have, if the files are mid-save or broken
+            if self._repo is None:
+                raise
+            return
+
+        if repo:
+            self._repo = repo
+            self._key = key
+
+
+_handle = FormulaRepoHandle()
+
+
 #----------------------------------------------------------------------------------------#
 #-------------------------------------------------------------------------------- MAIN --#
 
@@ -16,12 +16,21 @@
 #----------------------------------------------------------------------------- IMPORTS --#
 
 # Built-In
+import atexit
+from contextlib import contextmanager
 from enum import Enum
-import inspect
+import functools
+import gzip
 import json
+import linecache
 import os
+import queue
+import secrets
+import shutil
+import socket
 import sys
-from time import localtime, strftime
+import threading
+from time import localtime, monotonic, perf_counter, strftime, thread_time, time
 
 # Third Party
 try:
@@ -33,6 +42,63 @@ except ImportError:
 # Internal
 from haymaker.formula_manager import eval_formula
 
+#----------------------------------------------------------------------------------------#
+#----------------------------------------------------------------------------- GLOBALS --#
+
+# log lines are written by a background thread in batches. a batch is written once it
+# is this old (seconds) or this big (characters)
+FLUSH_INTERVAL = 1.0
+FLUSH_SIZE = 64 * 1024
+
+# errors are written to disk before log() returns, so they survive a crash
+DURABLE_ERRORS = True
+
+# console messages are wrapped to this many characters. None doesn't wrap, which is the
+# default for batch processes (mayabatch) since nobody reads their console
+CONSOLE_WIDTH = 120
+if MAYA:
+    try:
+        if cmds.about(batch=True):
+            CONSOLE_WIDTH = None
+    except (AttributeError, RuntimeError):
+        pass
+
+# a session's log moves on to a new file once it is this big (characters) or this old
+# (seconds), even while the session is idle. finished log files are gzipped, logs of other
+# sessions once they haven't been written for twice LOG_MAX_AGE (they could still be open)
+LOG_MAX_SIZE = 10 * 1024 * 1024
+LOG_MAX_AGE = 24 * 60 * 60
+
+# old logs in the user's log folder are deleted once they are older than this (days) or
+# there are more than this many
+LOG_RETENTION_DAYS = 30
+LOG_RETENTION_COUNT = 200
+
+# repeats of a message (same level and format string) within this many seconds of the
+# first are counted instead of logged, and summarised with a few examples once the window
+# is over. 0 logs every message. only applies to COALESCE_LEVELS
+COALESCE_WINDOW = 2.0
+COALESCE_EXAMPLES = 3
+
+# child processes (e.g. mayabatch) started with get_child_env send their log records to
+# the parent's log instead of starting their own, tagged with a job id
+ENV_LOG_ADDRESS = 'HAYMAKER_LOG_ADDRESS'
+ENV_LOG_TOKEN = 'HAYMAKER_LOG_TOKEN'
+ENV_LOG_JOB = 'HAYMAKER_LOG_JOB'
+
+# metrics (see counter, histogram) are written to this folder in the Prometheus text
+# format every METRICS_INTERVAL seconds, for a node-local collector to scrape. one file per
+# process, and every sample has a pid label so the files never share a series. a file is
+# removed when its process quits, or by any other process once it hasn't been written to
+# for METRICS_STALE seconds (its process crashed)
+DIR_METRICS = '~/.haymaker/metrics'
+METRICS_INTERVAL = 15.0
+METRICS_STALE = 4 * METRICS_INTERVAL
+HISTOGRAM_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0,
+    300.0
+)
+
 #----------------------------------------------------------------------------------------#
 #------------------------------------------------------------------------------- ENUMS --#
 
@@ -44,15 +110,193 @@ class Level(Enum):
     ERROR = 'Error'
 
 
+# used to compare levels against the thresholds (see set_level)
+_LEVEL_RANK = {level: i for i, level in enumerate(Level)}
+_file_rank = _LEVEL_RANK[Level.TRACE]
+_console_rank = _LEVEL_RANK[Level.TRACE]
+_min_rank = min(_file_rank, _console_rank)
+
+# how many frames of the stack to capture for each level, None captures all of them
+TRACE_DEPTH = {
+    Level.TRACE: 0,
+    Level.INFO: 1,
+    Level.WARN: None,
+    Level.ERROR: None,
+}
+
+# level of the records written when a span finishes (see span)
+SPAN_LEVEL = Level.INFO
+
+# levels whose repeats are coalesced (see COALESCE_WINDOW). warnings and errors are always
+# logged in full, so each keeps its trace and errors are still written durably
+COALESCE_LEVELS = {Level.TRACE, Level.INFO}
+
+
 #----------------------------------------------------------------------------------------#
 #--------------------------------------------------------------------------- FUNCTIONS --#
 
 
-def log(message, level=Level.INFO, step_back=2, width=120):
-    trace = _build_trace(step_back)
+def log(message, *args, level=Level.INFO, step_back=2, width=0):
+    """
+    Logs a message to the session log file and the console.
+
+    Messages below the file and console levels (see set_level) return before doing any
+    work, and formatting is deferred until a message is known to be needed. To keep
+    logging cheap in loops, pass %-style args or a callable instead of an f-string.
+        log('updated %s to a user path (%s)', node, path)
+        log(lambda: describe(node), level=Level.TRACE)
+
+    Repeats of a trace/info message within COALESCE_WINDOW are counted, not logged, see
+    flush_repeats.
+
+    :param message: message, %-style format string, or a callable returning the message.
+    :param args: values for the format string.
+    :param width: console width to wrap at, CONSOLE_WIDTH by default. None doesn't wrap.
+    """
+    rank = _LEVEL_RANK[level]
+    if rank < _min_rank:
+        return
+
+    if COALESCE_WINDOW:
+        if monotonic() >= _repeats_deadline:
+            flush_repeats(expired_only=True)
+        if level in COALESCE_LEVELS and _count_repeat(message, args, level):
+            return
+
+    if callable(message):
+        message = message()
+    if args:
+        message = message % args
+
+    depth = TRACE_DEPTH.get(level)
+    trace = _build_trace(step_back, depth) if depth != 0 else []
+
+    if rank >= _file_rank:
+        _log_to_file(message, level, trace)
+    if rank >= _console_rank:
+        _log_to_console(message, level, trace, width)
+
+
+def span(name: str) -> '_Span':
+    """
+    Times a block of code, or every call of a function. When the outermost span finishes,
+    its wall time, CPU time (of this thread) and child spans are written to the session
+    log as one record, see log_query.LogIndex.span_stats.
+        with span('Export Material Assignments'):
+            ...
+
+        @span('save')
+        def save_file(): ...
+    """
+    return _Span(name)
+
+
+def timed(func=None, *, name: str = None):
+    """
+    Decorator that wraps every call of a function in a span, named after the function.
+        @timed
+        def version_file(): ...
+    """
+    if func is None:
+        return lambda f: timed(f, name=name)
+    return _Span(name or f'{func.__module__}.{func.__qualname__}')(func)
+
+
+def flush_repeats(expired_only=False):
+    """
+    Logs a summary of the repeated messages that were held back (see COALESCE_WINDOW).
+    The summary's record keeps the count, format string and examples under 'repeat'.
+    """
+    global _repeats_deadline
+    now = monotonic()
+    with _repeats_lock:
+        if expired_only:
+            keys = [key for key, repeat in _repeats.items() if now >= repeat.deadline]
+        else:
+            keys = list(_repeats)
+        finished = [_repeats.pop(key) for key in keys]
+        _repeats_deadline = min(
+            (repeat.deadline for repeat in _repeats.values()), default=float('inf')
+        )
+
+    for repeat in finished:
+        if repeat.count:
+            repeat.emit()
+
+
+def get_child_env(job: str) -> dict:
+    """
+    Environment variables for a child process, so its log records are merged into this
+    session's log (tagged with the job id) instead of a log file of its own.
+        env = {**os.environ, **get_child_env('Publish shot_010')}
+    """
+    global _server
+    with _server_lock:
+        if _server is None:
+            _server = _LogServer()
+
+    host, port = _server.address
+    return {
+        ENV_LOG_ADDRESS: f'{host}:{port}',
+        ENV_LOG_TOKEN: _server.token,
+        ENV_LOG_JOB: job,
+    }
+
+
+def counter(name: str, description: str = '', labels=()) -> '_Counter':
+    """
+    Gets (or creates) a counter in the metrics registry.
+        _files_versioned = counter('haymaker_files_versioned_total', 'Files versioned')
+        _files_versioned.inc()
+    """
+    return _get_metric(_Counter, name, description, labels)
+
+
+def histogram(name: str, description: str = '', labels=(),
+              buckets=HISTOGRAM_BUCKETS) -> '_Histogram':
+    """
+    Gets (or creates) a histogram in the metrics registry.
+        _publish_seconds = histogram('haymaker_publish_seconds', 'Publish durations')
+        with _publish_seconds.time():
+            ...
+    """
+    return _get_metric(_Histogram, name, description, labels, buckets)
+
+
+def format_metrics() -> str:
+    """
+    :return: every metric in the Prometheus text format.
+    """
+    with _metrics_lock:
+        metrics = list(_metrics.values())
+    return ''.join(metric.format() for metric in metrics)
 
-    _log_to_file(message, level, trace)
-    _log_to_console(message, level, trace, width)
+
+def write_metrics(path: str = None):
+    """
+    Writes the metrics file now, see DIR_METRICS.
+    """
+    path = os.path.expanduser(path or _get_metrics_path())
+    data = format_metrics()
+
+    # collectors can read the file at any time, so swap in a complete one
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    path_temp = f'{path}.tmp'
+    with open(path_temp, 'w') as file:
+        file.write(data)
+    os.replace(path_temp, path)
+
+
+def set_level(file: Level = None, console: Level = None):
+    """
+    Sets the minimum level of messages sent to the log file and/or the console.
+    """
+    global _file_rank, _console_rank, _min_rank
+    if file:
+        _file_rank = _LEVEL_RANK[file]
+    if console:
+        _console_rank = _LEVEL_RANK[console]
+    _min_rank = min(_file_rank, _console_rank)
 
 
 def submit_log():
@@ -60,50 +304,88 @@ def submit_log():
     if not _path_log:
         _start_log()
 
-    log_name = os.path.join(os.getlogin(), os.path.basename(_path_log))
+    log_name = os.path.join(os.getlogin(), os.path.basename(_writer.path))
     path_report = eval_formula('f_log_report')
     os.makedirs(os.path.dirname(path_report), exist_ok=True)
     with open(path_report, 'a') as file:
         file.write(f'- [ ] {log_name}\n')
 
 
-def _log_to_console(message, level, trace, width):
-    time_str = strftime("%H:%M:%S", localtime())
+_repeats = {}
+_repeats_deadline = float('inf')
+_repeats_lock = threading.Lock()
+def _count_repeat(message, args, level) -> bool:
+    # messages are grouped by their format string, or the code of a callable message, so
+    # they're grouped before doing the work of formatting them
+    global _repeats_deadline
+    template = getattr(message, '__code__', message)
+    key = (template, level)
+    with _repeats_lock:
+        repeat = _repeats.get(key)
+        if repeat is None:
+            repeat = _repeats[key] = _Repeat(template, level)
+            _repeats_deadline = min(_repeats_deadline, repeat.deadline)
+            return False
+        repeat.add(message, args)
+        return True
 
-    # noinspection PyTypeChecker
-    s = f'{time_str}  [{level.value.upper()}]  '
-    indent = ''.join([' ' for _ in s])
-    lines = []
 
-    # wrap lines to fit width
-    for c in message:
-        s += c
-        if c == '\n' or len(s) >= width:
-            lines.append(s)
-            s = indent
+# level labels and the matching indent for wrapped lines. every prefix is the same
+# length since the time is always HH:MM:SS
+_console_labels = {level: f'  [{level.value.upper()}]  ' for level in Level}
+_console_indents = {
+    level: ' ' * (len('00:00:00') + len(label)) for level, label in _console_labels.items()
+}
+_console_time = (None, '')
+def _log_to_console(message, level, trace, width):
+    # the time only changes once a second
+    global _console_time
+    now = int(time())
+    if _console_time[0] != now:
+        _console_time = (now, strftime("%H:%M:%S", localtime(now)))
+    prefix = _console_time[1] + _console_labels[level]
+    indent = _console_indents[level]
 
-    # send to console
-    lines.append(s)
-    print('\n'.join(lines))
+    if width == 0:
+        width = CONSOLE_WIDTH
 
-    if level == Level.TRACE or level == Level.INFO:
-        return
+    # wrap lines to fit width
+    if not width:
+        out = [prefix, message.replace('\n', '\n' + indent), '\n']
+    else:
+        out = [prefix]
+        size = max(1, width - len(indent))
+        first = True
+        for line in message.split('\n'):
+            if not first:
+                out.append(indent)
+            first = False
+            if len(line) <= size:
+                out.append(line)
+                out.append('\n')
+                continue
+            out.append(line[:size])
+            out.append('\n')
+            for i in range(size, len(line), size):
+                out.append(indent)
+                out.append(line[i:i + size])
+                out.append('\n')
 
     # show stack trace, for warnings/errors
-    for frame in trace:
-        file = frame['file']
-        line = frame['line']
-        function = frame['function']
-        context = frame['context']
-        print(f'  File "{file}", line {line}, in {function}')
-        if context:
-            print(f'    {context.lstrip()}')
+    if level != Level.TRACE and level != Level.INFO:
+        for frame in _render_trace(trace):
+            out.append(f'  File "{frame["file"]}", line {frame["line"]}, '
+                       f'in {frame["function"]}\n')
+            if frame['context']:
+                out.append(f'    {frame["context"].lstrip()}\n')
 
+    # send to console
+    sys.stdout.write(''.join(out))
 
-def _log_to_file(message, level, trace):
+
+def _log_to_file(message, level, trace, extra=None):
     # lazy-load log file
-    global _file_log
-    if not _file_log:
+    if not _writer:
         _start_log()
 
     # format message
@@ -113,44 +395,79 @@ def _log_to_file(message, level, trace):
         'message': message,
         'trace': trace,
     }
-    str_data = json.dumps(data) + '\n'
-
-    # send to log
-    _file_log.write(str_data)
+    if extra:
+        data.update(extra)
 
-    # save file immediately (because we leave it)
-    _file_log.flush()
-    os.fsync(_file_log.fileno())
+    # send to log, the writer thread formats it and saves it to disk
+    _writer.write(data)
+    if DURABLE_ERRORS and level == Level.ERROR:
+        _writer.sync()
 
 
-def _build_trace(steps_back=2):
-    stack = iter(inspect.stack())
-    for i in range(steps_back):
-        next(stack)
+def _build_trace(steps_back=2, depth=None):
+    # only grab file/line/function from the frames, the source is read when (and if)
+    # the trace is rendered
+    try:
+        frame = sys._getframe(steps_back)
+    except ValueError:
+        return []
 
     trace = []
-    for frame in stack:
-        # if frame.function == '<module>':
-        #     continue
-        trace.append({
-            'file': frame.filename,
-            'line': frame.lineno,
-            'function': frame.function,
-            'context': frame.code_context[0][:-1] if frame.code_context else None,
-        })
+    while frame is not None and (depth is None or len(trace) < depth):
+        code = frame.f_code
+        trace.append((code.co_filename, frame.f_lineno, code.co_name))
+        frame = frame.f_back
 
     return trace
 
 
+def _render_trace(trace):
+    return [
+        {
+            'file': file,
+            'line': line,
+            'function': function,
+            'context': linecache.getline(file, line).rstrip('\n') or None,
+        }
+        for file, line, function in trace
+    ]
+
+
+def _log_line(line: str):
+    # a formatted record, e.g. from a child process
+    if not _writer:
+        _start_log()
+    _writer.write(line)
+
+
+def _format_record(record: dict) -> str:
+    return json.dumps({**record, 'trace': _render_trace(record['trace'])}) + '\n'
+
+
 _path_log = None
-_file_log = None
+_writer: '_LogWriter' = None
+_server: '_LogServer' = None
+_server_lock = threading.Lock()
 def _start_log():
     # close the previous log
     # this shouldn't happen outside a developer context
-    global _file_log
+    global _writer
     global _path_log
-    if _file_log:
-        _file_log.close()
+    if _writer:
+        _writer.close()
+    _register_shutdown()
+
+    # send records to the parent process, if it's listening
+    if os.environ.get(ENV_LOG_ADDRESS):
+        try:
+            _writer = _LogForwarder(
+                os.environ[ENV_LOG_ADDRESS], os.environ.get(ENV_LOG_TOKEN, ''),
+                os.environ.get(ENV_LOG_JOB, '')
+            )
+            _show_startup_info()
+            return
+        except (OSError, ValueError) as e:
+            print(f'Unable to send log to parent process :: {e}', file=sys.stderr)
 
     # build log path
     user = os.getlogin().lower()
@@ -160,11 +477,39 @@ def _start_log():
 
     # create empty log file
     os.makedirs(os.path.dirname(_path_log), exist_ok=True)
-    _file_log = open(_path_log, 'w')
+    _writer = _LogWriter(_path_log)
 
     _show_startup_info()
 
 
+_shutdown_registered = False
+def _register_shutdown():
+    # make sure queued messages make it to disk before the interpreter goes away
+    global _shutdown_registered
+    if _shutdown_registered:
+        return
+    _shutdown_registered = True
+    atexit.register(shutdown)
+    if MAYA:
+        try:
+            cmds.scriptJob(event=['quitApplication', shutdown])
+        except RuntimeError:
+            pass
+
+
+def shutdown():
+    """
+    Writes any queued messages and closes the log file. Safe to call more than once.
+    """
+    flush_repeats()
+    if _metrics_writer:
+        _metrics_writer.close()
+    if _server:
+        _server.close()
+    if _writer:
+        _writer.close()
+
+
 def _show_startup_info():
     log(f'Starting log for {os.getlogin()}...')
 
@@ -176,9 +521,624 @@ def _show_startup_info():
     log(f'Python {sys.version}')
 
 
+def _compress_log(path: str) -> bool:
+    """
+    Replaces a log file with a gzipped copy (path.gz).
+
+    :return: success
+    """
+    path_gz = f'{path}.gz'
+    path_temp = f'{path_gz}.tmp'
+    try:
+        with open(path, 'rb') as file_src, gzip.open(path_temp, 'wb') as file_dst:
+            shutil.copyfileobj(file_src, file_dst)
+        # the log could still be open by another session (fails on Windows)
+        os.remove(path)
+    except OSError:
+        if os.path.isfile(path_temp):
+            os.remove(path_temp)
+        return False
+
+    os.replace(path_temp, path_gz)
+    return True
+
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+_metrics_writer: '_MetricsWriter' = None
+def _get_metric(cls, name, description, labels, *args):
+    with _metrics_lock:
+        metric = _metrics.get(name)
+        if metric is None:
+            metric = _metrics[name] = cls(name, description, tuple(labels), *args)
+        elif type(metric) is not cls or metric.labels != tuple(labels):
+            raise ValueError(f'Metric {name} already exists with a different type/labels')
+    return metric
+
+
+def _metric_changed():
+    # start writing the metrics file once there is something to write
+    global _metrics_writer
+    if _metrics_writer is None:
+        with _metrics_lock:
+            if _metrics_writer is None:
+                _register_shutdown()
+                _metrics_writer = _MetricsWriter()
+
+
+def _get_metrics_path() -> str:
+    return os.path.join(DIR_METRICS, f'haymaker_{os.getpid()}.prom')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    # every process has its own file, the pid keeps their series apart
+    labels = [f'pid="{os.getpid()}"']
+    labels.extend(
+        f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)
+    )
+    if extra:
+        labels.append(extra)
+    return '{' + ','.join(labels) + '}'
+
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _merge_span(spans: list, data: dict):
+    # adds a finished span to a list of siblings, merging it with one of the same name
+    for span_ in spans:
+        if span_['name'] == data['name']:
+            break
+    else:
+        spans.append(data)
+        return
+
+    span_['wall'] += data['wall']
+    span_['cpu'] += data['cpu']
+    span_['count'] += data['count']
+    for child in data['children']:
+        _merge_span(span_['children'], child)
+    if 'error' in data:
+        span_['error'] = data['error']
+
+
 #----------------------------------------------------------------------------------------#
 #----------------------------------------------------------------------------- CLASSES --#
 
+
+class _LogWriter(threading.Thread):
+    """
+    Writes lines to a log file from a background thread, so callers never wait on the
+    disk. Lines are batched and written once the batch is FLUSH_INTERVAL seconds old or
+    FLUSH_SIZE characters long.
+
+    The writer also looks after the log folder. The log is rotated into numbered parts
+    (LOG_MAX_SIZE, LOG_MAX_AGE), finished parts and logs from old sessions are gzipped,
+    and old logs are pruned (LOG_RETENTION_DAYS, LOG_RETENTION_COUNT). Gzipping and
+    pruning run on their own threads, so they never hold up a sync().
+    """
+    _CLOSE = object()
+
+    def __init__(self, path: str):
+        super().__init__(name='haymaker.log', daemon=True)
+        self.path = path
+        self._path_session = path
+        self._part = 0
+        self._file = self._open()
+        self._size = 0
+        self._opened = time()
+        self._queue = queue.SimpleQueue()
+        self._closed = False
+        self.start()
+
+    def _open(self):
+        return open(self.path, 'w')
+
+    def write(self, record):
+        """
+        Queues a log record (dict) or an already formatted line.
+        """
+        if self._closed:
+            # late messages, e.g. from other atexit hooks, are written straight away
+            with open(self.path, 'a') as file:
+                file.write(record if isinstance(record, str) else _format_record(record))
+            return
+        self._queue.put(record)
+
+    def sync(self):
+        """
+        Blocks until everything written so far is on disk.
+        """
+        if self._closed or not self.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        """
+        Writes the remaining lines and closes the file.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(self._CLOSE)
+        self.join()
+
+    def run(self):
+        self._start_maintenance(self._archive_old_logs)
+
+        batch = []
+        size = 0
+        deadline = None
+        while True:
+            try:
+                if batch:
+                    timeout = max(0.0, deadline - monotonic())
+                else:
+                    # an idle log still has to rotate on time
+                    timeout = max(0.0, self._opened + LOG_MAX_AGE - time())
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                # the batch is old enough, or the log is
+                self._flush(batch)
+                batch, size = [], 0
+                continue
+
+            if isinstance(item, dict):
+                item = _format_record(item)
+            if isinstance(item, str):
+                if not batch:
+                    deadline = monotonic() + FLUSH_INTERVAL
+                batch.append(item)
+                size += len(item)
+                if size >= FLUSH_SIZE:
+                    self._flush(batch)
+                    batch, size = [], 0
+                continue
+
+            # sync or close
+            self._flush(batch, fsync=True)
+            batch, size = [], 0
+            if item is self._CLOSE:
+                self._file.close()
+                return
+            item.set()
+
+    def _flush(self, batch: list, fsync: bool = False):
+        try:
+            if batch:
+                data = ''.join(batch)
+                self._file.write(data)
+                self._file.flush()
+                self._size += len(data)
+            if fsync:
+                os.fsync(self._file.fileno())
+            if self._size >= LOG_MAX_SIZE or time() - self._opened >= LOG_MAX_AGE:
+                self._rotate()
+        except OSError as e:
+            # nowhere else to report this, the log itself is broken
+            print(f'Unable to write to log {self.path} :: {e}', file=sys.stderr)
+
+    def _rotate(self):
+        # an empty log is only touched, so other sessions can see it's still open
+        if not self._size:
+            os.utime(self.path)
+            self._opened = time()
+            return
+
+        # session.log -> session.1.log -> session.2.log ...
+        self._file.close()
+        path_done = self.path
+
+        self._part += 1
+        root, ext = os.path.splitext(self._path_session)
+        self.path = f'{root}.{self._part}{ext}'
+        self._file = open(self.path, 'w')
+        self._size = 0
+        self._opened = time()
+
+        self._start_maintenance(_compress_log, path_done)
+
+    @staticmethod
+    def _start_maintenance(target, *args):
+        # the log folder is on the synced drive, so gzipping and pruning can be slow, and
+        # a durable error blocks its caller until the writer gets to its sync
+        threading.Thread(
+            target=target, args=args, name='haymaker.log.archive', daemon=True
+        ).start()
+
+    def _archive_old_logs(self):
+        directory = os.path.dirname(self.path)
+        try:
+            with os.scandir(directory) as it:
+                entries = [entry for entry in it if entry.is_file()]
+        except OSError:
+            return
+
+        # logs that haven't been touched for a while belong to finished sessions. open
+        # logs are written to, or at least touched, every LOG_MAX_AGE (see _rotate)
+        now = time()
+        archives = []
+        for entry in entries:
+            try:
+                modified = entry.stat().st_mtime
+            except OSError:
+                continue
+            if entry.name.endswith('.log') and entry.path != self.path:
+                if now - modified >= 2 * LOG_MAX_AGE and _compress_log(entry.path):
+                    archives.append((modified, f'{entry.path}.gz'))
+            elif entry.name.endswith('.log.gz'):
+                archives.append((modified, entry.path))
+            elif entry.name.endswith('.log.gz.tmp') and now - modified >= LOG_MAX_AGE:
+                # gzipping was cut short by the session quitting
+                archives.append((0, entry.path))
+
+        # prune by age, then by count (newest are kept)
+        archives.sort(reverse=True)
+        cutoff = now - LOG_RETENTION_DAYS * 24 * 60 * 60
+        for i, (modified, path) in enumerate(archives):
+            if modified < cutoff or i >= LOG_RETENTION_COUNT:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+class _LogForwarder(_LogWriter):
+    """
+    Log writer for child processes, which sends the lines to the parent's _LogServer.
+    Records are tagged with the job id.
+    """
+
+    def __init__(self, address: str, token: str, job: str):
+        host, port = address.rsplit(':', 1)
+        self.job = job
+        self._socket = socket.create_connection((host, int(port)), timeout=10)
+        self._socket.settimeout(None)
+        self._socket.sendall((json.dumps({'token': token, 'job': job}) + '\n').encode())
+        super().__init__(None)
+
+    def _open(self):
+        return self._socket.makefile('w', encoding='utf-8')
+
+    def write(self, record):
+        if isinstance(record, dict):
+            record['job'] = self.job
+        if self._closed:
+            # the connection is gone, nowhere to send late messages
+            return
+        self._queue.put(record)
+
+    def run(self):
+        try:
+            super().run()
+        finally:
+            self._socket.close()
+
+    def _archive_old_logs(self):
+        pass
+
+    def _flush(self, batch: list, fsync: bool = False):
+        if not batch:
+            return
+        try:
+            self._file.write(''.join(batch))
+            self._file.flush()
+        except OSError as e:
+            print(f'Unable to send log to parent process :: {e}', file=sys.stderr)
+            # the parent is gone, drop the rest
+            self._file = open(os.devnull, 'w')
+
+
+class _LogServer(threading.Thread):
+    """
+    Receives log lines from child processes (see get_child_env) and adds them to this
+    session's log. Only listens on localhost, and children have to know the token.
+    """
+
+    def __init__(self):
+        super().__init__(name='haymaker.log.server', daemon=True)
+        self.token = secrets.token_hex(16)
+        self._socket = socket.create_server(('127.0.0.1', 0))
+        self.address = self._socket.getsockname()[:2]
+        self._closed = False
+        self.start()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._socket.close()
+
+    def run(self):
+        while not self._closed:
+            try:
+                connection, _ = self._socket.accept()
+            except OSError:
+                return
+            threading.Thread(
+                target=self._receive, args=(connection,), name='haymaker.log.child',
+                daemon=True
+            ).start()
+
+    def _receive(self, connection: socket.socket):
+        with connection, connection.makefile('r', encoding='utf-8') as file:
+            try:
+                hello = json.loads(file.readline())
+            except (OSError, ValueError):
+                return
+            if not isinstance(hello, dict) or hello.get('token') != self.token:
+                return
+
+            job = hello.get('job')
+            self._mark(f'Receiving log from job {job}', job)
+            try:
+                for line in file:
+                    # skip a partial line from a child that died mid-write
+                    if line.endswith('\n'):
+                        _log_line(line)
+            except OSError:
+                pass
+            self._mark(f'Job {job} closed its log', job)
+
+    @staticmethod
+    def _mark(message: str, job):
+        # file only, this runs on a socket thread and Maya's console is only safe on the
+        # main thread
+        if _LEVEL_RANK[Level.INFO] >= _file_rank:
+            _log_to_file(message, Level.INFO, [], {'job': job})
+
+
+class _Metric:
+    """
+    Base for metrics in the registry, see counter and histogram. Values are kept per
+    combination of label values.
+    """
+    TYPE = None
+
+    def __init__(self, name: str, description: str, labels: tuple):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        if len(labels) != len(self.labels):
+            raise ValueError(f'Metric {self.name} needs the labels {self.labels}')
+        return tuple(labels[name] for name in self.labels)
+
+    def format(self) -> str:
+        lines = []
+        if self.description:
+            lines.append(f'# HELP {self.name} {self.description}')
+        lines.append(f'# TYPE {self.name} {self.TYPE}')
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            lines.extend(self._format_value(key, value))
+        return '\n'.join(lines) + '\n'
+
+    def _format_value(self, key: tuple, value) -> list:
+        raise NotImplementedError
+
+
+class _Counter(_Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        _metric_changed()
+
+    def _format_value(self, key, value):
+        return [f'{self.name}{_format_labels(self.labels, key)} {value}']
+
+
+class _Histogram(_Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: tuple,
+                 buckets=HISTOGRAM_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # [count per bucket..., +Inf, sum]
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-2] += 1
+            counts[-1] += value
+        _metric_changed()
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes how long the block takes, in seconds.
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def _format_value(self, key, value):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), value[:-1]):
+            total += count
+            labels = _format_labels(self.labels, key, f'le="{bound}"')
+            lines.append(f'{self.name}_bucket{labels} {total}')
+        labels = _format_labels(self.labels, key)
+        lines.append(f'{self.name}_sum{labels} {value[-1]}')
+        lines.append(f'{self.name}_count{labels} {total}')
+        return lines
+
+
+class _MetricsWriter(threading.Thread):
+    """
+    Writes the metrics file every METRICS_INTERVAL seconds, and removes it on close.
+    """
+
+    def __init__(self):
+        super().__init__(name='haymaker.metrics', daemon=True)
+        self._stopping = threading.Event()
+        self.start()
+
+    def close(self):
+        self._stopping.set()
+        self.join()
+
+    def run(self):
+        while not self._stopping.wait(METRICS_INTERVAL):
+            # written even when nothing changed, the file's age shows the process is alive
+            try:
+                write_metrics()
+            except OSError as e:
+                print(f'Unable to write metrics :: {e}', file=sys.stderr)
+            self._remove_stale_files()
+
+        # a quit process shouldn't be scraped
+        try:
+            os.remove(os.path.expanduser(_get_metrics_path()))
+        except OSError:
+            pass
+
+    @staticmethod
+    def _remove_stale_files():
+        # files of processes that crashed
+        directory = os.path.expanduser(DIR_METRICS)
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            return
+        now = time()
+        for entry in entries:
+            try:
+                modified = entry.stat().st_mtime
+                if entry.name.endswith('.prom') and now - modified >= METRICS_STALE:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+
+class _Repeat:
+    """
+    A message repeating within COALESCE_WINDOW. See flush_repeats.
+    """
+    __slots__ = ('template', 'level', 'deadline', 'count', 'examples')
+
+    def __init__(self, template, level: Level):
+        self.template = template
+        self.level = level
+        self.deadline = monotonic() + COALESCE_WINDOW
+        self.count = 0
+        self.examples = []
+
+    def add(self, message, args):
+        self.count += 1
+        if len(self.examples) < COALESCE_EXAMPLES:
+            if callable(message):
+                message = message()
+            if args:
+                message = message % args
+            self.examples.append(message)
+
+    def emit(self):
+        template = self.template
+        if not isinstance(template, str):
+            code = template
+            template = f'{code.co_name} ({code.co_filename}:{code.co_firstlineno})'
+        message = (f'Repeated {self.count:,} more times: {template}, e.g. '
+                   f'{"; ".join(self.examples)}')
+
+        rank = _LEVEL_RANK[self.level]
+        if rank >= _file_rank:
+            _log_to_file(message, self.level, [], {'repeat': {
+                'count': self.count,
+                'template': template,
+                'examples': self.examples,
+            }})
+        if rank >= _console_rank:
+            _log_to_console(message, self.level, [], 0)
+
+
+class _Span:
+    """
+    See span. Children that run more than once (e.g. in a loop) are merged into one entry
+    with a count, so records stay small.
+    """
+    _local = threading.local()
+
+    def __init__(self, name: str):
+        self.name = name
+        self.children = []
+        self._parent = None
+        self._wall = None
+        self._cpu = None
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # a new span per call, so calls can nest and run on several threads
+            with _Span(self.name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def __enter__(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        self._parent = stack[-1] if stack else None
+        stack.append(self)
+        self._cpu = thread_time()
+        self._wall = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        wall = perf_counter() - self._wall
+        cpu = thread_time() - self._cpu
+        self._local.stack.pop()
+
+        data = {
+            'name': self.name,
+            'wall': wall,
+            'cpu': cpu,
+            'count': 1,
+            'children': self.children,
+        }
+        if exc_type is not None:
+            data['error'] = exc_type.__name__
+
+        if self._parent is not None:
+            _merge_span(self._parent.children, data)
+            return
+
+        # the tool is done, show what it held back
+        if COALESCE_WINDOW:
+            flush_repeats()
+
+        rank = _LEVEL_RANK[SPAN_LEVEL]
+        if rank < _min_rank:
+            return
+        message = f'{self.name} took {wall:.3f}s ({cpu:.3f}s cpu)'
+        if rank >= _file_rank:
+            _log_to_file(message, SPAN_LEVEL, [], {'span': data})
+        if rank >= _console_rank:
+            _log_to_console(message, SPAN_LEVEL, [], 0)
+
+
 #----------------------------------------------------------------------------------------#
 #-------------------------------------------------------------------------------- MAIN --#
 
@@ -0,0 +1,533 @@
+#!/usr/bin/env python
+#SETMODE 777
+
+#----------------------------------------------------------------------------------------#
+#------------------------------------------------------------------------------ HEADER --#
+
+"""
+:author:
+    Nick Maclean
+
+:synopsis:
+    Search the session logs of every user. Logs are indexed (time, level, user, the
+    functions in the trace, and the words in the message) into a local sqlite database,
+    and each update only reads what was written since the last one.
+
+    python -m haymaker.log_query --level error --function foolproof_user_reference
+        --since 7d
+
+    from haymaker.log_query import LogIndex
+    for record in LogIndex().query(levels=['Error'], since='7d'):
+        ...
+
+    Timings from haymaker.log.span (e.g. every menu tool) are summarised with --spans,
+    or LogIndex.span_stats.
+"""
+
+#----------------------------------------------------------------------------------------#
+#----------------------------------------------------------------------------- IMPORTS --#
+
+# Built-In
+import argparse
+from datetime import datetime, timedelta
+import gzip
+import json
+import math
+import os
+import re
+import sqlite3
+import sys
+
+# Internal
+from haymaker.formula_manager import eval_formula, FormulaRepo
+from haymaker.log import Level
+
+#----------------------------------------------------------------------------------------#
+#----------------------------------------------------------------------------- GLOBALS --#
+
+# bump this when the tables change, old indexes are rebuilt
+SCHEMA_VERSION = 2
+
+_SCHEMA = '''
+CREATE TABLE files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    user TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    offset INTEGER NOT NULL
+);
+CREATE TABLE records (
+    id INTEGER PRIMARY KEY,
+    file_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    level TEXT NOT NULL,
+    user TEXT NOT NULL,
+    message TEXT NOT NULL,
+    trace TEXT NOT NULL
+);
+CREATE INDEX records_date ON records (date);
+CREATE INDEX records_level ON records (level, date);
+CREATE INDEX records_user ON records (user, date);
+CREATE INDEX records_file ON records (file_id);
+CREATE TABLE tokens (
+    token TEXT NOT NULL,
+    record_id INTEGER NOT NULL,
+    PRIMARY KEY (token, record_id)
+) WITHOUT ROWID;
+CREATE INDEX tokens_record ON tokens (record_id);
+CREATE TABLE functions (
+    function TEXT NOT NULL,
+    record_id INTEGER NOT NULL,
+    PRIMARY KEY (function, record_id)
+) WITHOUT ROWID;
+CREATE INDEX functions_record ON functions (record_id);
+CREATE TABLE spans (
+    name TEXT NOT NULL,
+    record_id INTEGER NOT NULL,
+    depth INTEGER NOT NULL,
+    wall REAL NOT NULL,
+    cpu REAL NOT NULL,
+    count INTEGER NOT NULL,
+    error INTEGER NOT NULL
+);
+CREATE INDEX spans_name ON spans (name);
+CREATE INDEX spans_record ON spans (record_id);
+'''
+
+_TOKEN = re.compile(r'\w+')
+_RELATIVE_TIME = re.compile(r'(\d+(?:\.\d+)?)([mhdw])')
+_RELATIVE_UNITS = {'m': 'minutes', 'h': 'hours', 'd': 'days', 'w': 'weeks'}
+
+# dates in the log are saved in this format, which also sorts correctly as text
+DATE_FORMAT = '%Y-%m-%d %H-%M-%S'
+
+#----------------------------------------------------------------------------------------#
+#--------------------------------------------------------------------------- FUNCTIONS --#
+
+
+def _tokenize(text: str) -> set:
+    return set(_TOKEN.findall(text.lower()))
+
+
+def _parse_time(value) -> str:
+    """
+    Converts a time to the log's date format. Accepts datetimes, times relative to now
+    ('30m', '12h', '7d', '2w') and dates ('2023-04-01', '2023-04-01 13:30').
+    """
+    if value is None or isinstance(value, str) and not value:
+        return None
+    if isinstance(value, datetime):
+        return value.strftime(DATE_FORMAT)
+
+    match = _RELATIVE_TIME.fullmatch(value)
+    if match:
+        amount, unit = match.groups()
+        delta = timedelta(**{_RELATIVE_UNITS[unit]: float(amount)})
+        return (datetime.now() - delta).strftime(DATE_FORMAT)
+
+    for date_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d', DATE_FORMAT):
+        try:
+            return datetime.strptime(value, date_format).strftime(DATE_FORMAT)
+        except ValueError:
+            pass
+    raise ValueError(f'Unable to read time "{value}"')
+
+
+def _parse_level(value) -> str:
+    if isinstance(value, Level):
+        return value.value
+    for level in Level:
+        if value.lower() in (level.name.lower(), level.value.lower()):
+            return level.value
+    raise ValueError(f'Unknown log level "{value}"')
+
+
+def _percentile(values: list, percent: float) -> float:
+    # nearest rank, values must be sorted
+    index = max(0, math.ceil(percent / 100 * len(values)) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def _walk_spans(data: dict, depth: int = 0):
+    # yields (span, depth) for a span and all of its children
+    yield data, depth
+    for child in data.get('children', []):
+        yield from _walk_spans(child, depth + 1)
+
+
+def _read_lines(path: str, offset: int):
+    """
+    Yields (line, end offset) for each complete line in a log, starting at offset. The
+    last line is skipped if the writer hasn't finished it yet.
+    """
+    if path.endswith('.gz'):
+        file = gzip.open(path, 'rb')
+    else:
+        file = open(path, 'rb')
+
+    with file:
+        file.seek(offset)
+        for line in file:
+            if not line.endswith(b'\n'):
+                return
+            offset += len(line)
+            yield line, offset
+
+
+#----------------------------------------------------------------------------------------#
+#----------------------------------------------------------------------------- CLASSES --#
+
+
+class LogIndex:
+    """
+    Index of the session logs in d_logs/<user>/ (plain and gzipped).
+
+    Plain logs are only ever appended to, so they are read from where the last update
+    stopped. Gzipped logs are read once. Files that have disappeared (deleted, or
+    replaced by their gzipped copy) are dropped from the index.
+    """
+    PATH_INDEX = os.path.join(FormulaRepo.DIR_STARTUP_CACHE, 'log_index.sqlite')
+
+    def __init__(self, path: str = None, dir_logs: str = None):
+        self.path = os.path.expanduser(path or self.PATH_INDEX)
+        self.dir_logs = dir_logs or eval_formula('d_logs')
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._connection = sqlite3.connect(self.path, timeout=30)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._create_tables()
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def update(self) -> int:
+        """
+        Indexes anything new in the log folder.
+
+        :return: number of new records.
+        """
+        db = self._connection
+        known = {
+            path: (file_id, size, mtime_ns, offset)
+            for file_id, path, size, mtime_ns, offset
+            in db.execute('SELECT id, path, size, mtime_ns, offset FROM files')
+        }
+
+        count = 0
+        for user, entry in self._scan_logs():
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+
+            file_id, size, mtime_ns, offset = known.pop(entry.path, (None, 0, 0, 0))
+            if file_id is not None:
+                if stat.st_size == size and stat.st_mtime_ns == mtime_ns:
+                    continue
+                # anything other than an append means the log has to be read again
+                if stat.st_size < offset or entry.name.endswith('.gz'):
+                    self._remove_file(file_id)
+                    file_id = None
+                    offset = 0
+
+            # a read error leaves the with block by raising, so the records read so far
+            # are rolled back along with the offset and are read again next time
+            try:
+                with db:
+                    if file_id is None:
+                        file_id = db.execute(
+                            'INSERT INTO files (path, user, size, mtime_ns, offset) '
+                            'VALUES (?, ?, 0, 0, 0)',
+                            (entry.path, user)
+                        ).lastrowid
+                    added, offset = self._index_file(file_id, entry.path, user, offset)
+                    db.execute(
+                        'UPDATE files SET size = ?, mtime_ns = ?, offset = ? '
+                        'WHERE id = ?',
+                        (stat.st_size, stat.st_mtime_ns, offset, file_id)
+                    )
+            except (OSError, EOFError) as e:
+                print(f'Unable to read log {entry.path} :: {e}', file=sys.stderr)
+                continue
+            count += added
+
+        # whatever is left has been deleted or archived
+        for file_id, *_ in known.values():
+            self._remove_file(file_id)
+
+        return count
+
+    def query(self, since=None, until=None, levels=None, users=None, function=None,
+              text=None, limit=None, update=True):
+        """
+        Finds log records, oldest first.
+
+        :param since: earliest time (datetime, '7d', '2023-04-01', ...). See _parse_time.
+        :param until: latest time.
+        :param levels: Levels or level names to include.
+        :param users: users to include.
+        :param function: only records with this function in their trace.
+        :param text: only records with every word of this text in their message.
+        :param limit: maximum number of records.
+        :param update: index new logs first.
+        :return: yields dicts like the log's records, plus 'user' and 'path'.
+        """
+        if update:
+            self.update()
+
+        where = []
+        params = []
+        since = _parse_time(since)
+        if since:
+            where.append('r.date >= ?')
+            params.append(since)
+        until = _parse_time(until)
+        if until:
+            where.append('r.date <= ?')
+            params.append(until)
+        if levels:
+            levels = [_parse_level(level) for level in levels]
+            where.append(f'r.level IN ({", ".join("?" for _ in levels)})')
+            params.extend(levels)
+        if users:
+            users = [user.lower() for user in users]
+            where.append(f'r.user IN ({", ".join("?" for _ in users)})')
+            params.extend(users)
+        if function:
+            where.append('r.id IN (SELECT record_id FROM functions WHERE function = ?)')
+            params.append(function)
+        for token in _tokenize(text or ''):
+            where.append('r.id IN (SELECT record_id FROM tokens WHERE token = ?)')
+            params.append(token)
+
+        sql = ('SELECT r.date, r.level, r.user, r.message, r.trace, f.path '
+               'FROM records r JOIN files f ON f.id = r.file_id')
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY r.date, r.id'
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(limit)
+
+        for date, level, user, message, trace, path in self._connection.execute(sql, params):
+            yield {
+                'date': date,
+                'level': level,
+                'user': user,
+                'message': message,
+                'trace': json.loads(trace),
+                'path': path,
+            }
+
+    def span_stats(self, since=None, until=None, users=None, name=None, nested=False,
+                   update=True) -> dict:
+        """
+        Latency of the spans in the logs (see haymaker.log.span), e.g. per menu tool.
+
+        :param since: earliest time, see query.
+        :param until: latest time.
+        :param users: users to include.
+        :param name: only spans with this name.
+        :param nested: include child spans, not just the outermost ones.
+        :param update: index new logs first.
+        :return: {name: {count, errors, mean, p50, p90, p99, max, cpu}}, times in seconds.
+        """
+        if update:
+            self.update()
+
+        where = ['(s.depth = 0 OR ?)']
+        params = [nested]
+        since = _parse_time(since)
+        if since:
+            where.append('r.date >= ?')
+            params.append(since)
+        until = _parse_time(until)
+        if until:
+            where.append('r.date <= ?')
+            params.append(until)
+        if users:
+            users = [user.lower() for user in users]
+            where.append(f'r.user IN ({", ".join("?" for _ in users)})')
+            params.extend(users)
+        if name:
+            where.append('s.name = ?')
+            params.append(name)
+
+        sql = ('SELECT s.name, s.wall, s.cpu, s.count, s.error '
+               'FROM spans s JOIN records r ON r.id = s.record_id '
+               f'WHERE {" AND ".join(where)}')
+
+        walls = {}
+        cpus = {}
+        errors = {}
+        for span_name, wall, cpu, count, error in self._connection.execute(sql, params):
+            # merged children only know their total, use the average of each call
+            walls.setdefault(span_name, []).extend([wall / count] * count)
+            cpus[span_name] = cpus.get(span_name, 0.0) + cpu
+            errors[span_name] = errors.get(span_name, 0) + error
+
+        stats = {}
+        for span_name in sorted(walls):
+            values = sorted(walls[span_name])
+            stats[span_name] = {
+                'count': len(values),
+                'errors': errors[span_name],
+                'mean': sum(values) / len(values),
+                'p50': _percentile(values, 50),
+                'p90': _percentile(values, 90),
+                'p99': _percentile(values, 99),
+                'max': values[-1],
+                'cpu': cpus[span_name] / len(values),
+            }
+        return stats
+
+    def _create_tables(self):
+        db = self._connection
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        if version == SCHEMA_VERSION:
+            return
+
+        with db:
+            for table in ('files', 'records', 'tokens', 'functions', 'spans'):
+                db.execute(f'DROP TABLE IF EXISTS {table}')
+            db.executescript(_SCHEMA)
+            db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    def _scan_logs(self):
+        # d_logs/<user>/*.log(.gz)
+        try:
+            users = [entry for entry in os.scandir(self.dir_logs) if entry.is_dir()]
+        except OSError:
+            return
+        for user in users:
+            try:
+                entries = list(os.scandir(user.path))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name.endswith(('.log', '.log.gz')) and entry.is_file():
+                    yield user.name.lower(), entry
+
+    def _index_file(self, file_id: int, path: str, user: str, offset: int):
+        db = self._connection
+        count = 0
+        for line, offset in _read_lines(path, offset):
+            try:
+                record = json.loads(line)
+                date = record['date']
+                level = record['level']
+                message = record['message']
+            except (ValueError, KeyError, TypeError):
+                continue
+
+            trace = record.get('trace') or []
+            record_id = db.execute(
+                'INSERT INTO records (file_id, date, level, user, message, trace) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (file_id, date, level, user, message, json.dumps(trace))
+            ).lastrowid
+            db.executemany(
+                'INSERT OR IGNORE INTO tokens (token, record_id) VALUES (?, ?)',
+                [(token, record_id) for token in _tokenize(message)]
+            )
+            db.executemany(
+                'INSERT OR IGNORE INTO functions (function, record_id) VALUES (?, ?)',
+                [(frame['function'], record_id) for frame in trace
+                 if isinstance(frame, dict) and frame.get('function')]
+            )
+            if isinstance(record.get('span'), dict):
+                db.executemany(
+                    'INSERT INTO spans (name, record_id, depth, wall, cpu, count, error) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(data['name'], record_id, depth, data['wall'], data['cpu'],
+                      data.get('count', 1), 'error' in data)
+                     for data, depth in _walk_spans(record['span'])]
+                )
+            count += 1
+
+        return count, offset
+
+    def _remove_file(self, file_id: int):
+        db = self._connection
+        with db:
+            records = 'SELECT id FROM records WHERE file_id = ?'
+            db.execute(f'DELETE FROM tokens WHERE record_id IN ({records})', (file_id,))
+            db.execute(f'DELETE FROM functions WHERE record_id IN ({records})', (file_id,))
+            db.execute(f'DELETE FROM spans WHERE record_id IN ({records})', (file_id,))
+            db.execute('DELETE FROM records WHERE file_id = ?', (file_id,))
+            db.execute('DELETE FROM files WHERE id = ?', (file_id,))
+
+
+#----------------------------------------------------------------------------------------#
+#-------------------------------------------------------------------------------- MAIN --#
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m haymaker.log_query', description='Search the session logs.'
+    )
+    parser.add_argument('text', nargs='?', help='words that must be in the message')
+    parser.add_argument('--since', help="'30m', '12h', '7d', '2w' or a date")
+    parser.add_argument('--until', help="'30m', '12h', '7d', '2w' or a date")
+    parser.add_argument('--level', action='append', dest='levels',
+                        help='trace, info, warning or error (repeatable)')
+    parser.add_argument('--user', action='append', dest='users', help='(repeatable)')
+    parser.add_argument('--function', help='function in the trace')
+    parser.add_argument('--limit', type=int)
+    parser.add_argument('--trace', action='store_true', help='show stack traces')
+    parser.add_argument('--json', action='store_true', help='print JSON lines')
+    parser.add_argument('--spans', action='store_true',
+                        help='show latency percentiles of timed spans (menu tools)')
+    parser.add_argument('--nested', action='store_true',
+                        help='with --spans, include child spans')
+    parser.add_argument('--index', help='path to the index database')
+    parser.add_argument('--logs', help='path to the log folder (default: d_logs)')
+    args = parser.parse_args(argv)
+
+    with LogIndex(args.index, args.logs) as index:
+        if args.spans:
+            stats = index.span_stats(
+                since=args.since, until=args.until, users=args.users, name=args.text,
+                nested=args.nested
+            )
+            if args.json:
+                print(json.dumps(stats))
+                return
+            print(f'{"span":<40} {"count":>7} {"errors":>7} {"p50":>9} {"p90":>9} '
+                  f'{"p99":>9} {"max":>9} {"cpu":>9}')
+            for span_name, row in stats.items():
+                print(f'{span_name[:40]:<40} {row["count"]:>7} {row["errors"]:>7} '
+                      f'{row["p50"]:>9.3f} {row["p90"]:>9.3f} {row["p99"]:>9.3f} '
+                      f'{row["max"]:>9.3f} {row["cpu"]:>9.3f}')
+            return
+
+        records = index.query(
+            since=args.since, until=args.until, levels=args.levels, users=args.users,
+            function=args.function, text=args.text, limit=args.limit
+        )
+        for record in records:
+            if args.json:
+                print(json.dumps(record))
+                continue
+
+            print(f'{record["date"]}  [{record["level"].upper()}]  {record["user"]}  '
+                  f'{record["message"]}')
+            if not args.trace:
+                continue
+            for frame in record['trace']:
+                print(f'  File "{frame["file"]}", line {frame["line"]}, '
+                      f'in {frame["function"]}')
+                if frame.get('context'):
+                    print(f'    {frame["context"].lstrip()}')
+
+
+if __name__ == '__main__':
+    main()
@@ -23,6 +23,7 @@ from dataclasses import dataclass
 from functools import wraps
 import os
 from tempfile import NamedTemporaryFile
+from uuid import uuid4
 
 # Third Party
 # noinspection PyUnresolvedReferences
@@ -34,9 +35,19 @@ import maya.mel as mel
 
 # Internal
 from haymaker.app_exe import notify_system, Process, AppExecuter
-from haymaker.log import log, Level
+from haymaker.log import counter, get_child_env, histogram, log, Level
 import haymaker.widgets as widgets
 
+#----------------------------------------------------------------------------------------#
+#----------------------------------------------------------------------------- GLOBALS --#
+
+_paths_fixed = counter(
+    'haymaker_paths_fixed_total', 'File paths updated by foolproof_paths', labels=('kind',)
+)
+_foolproof_seconds = histogram(
+    'haymaker_foolproof_paths_seconds', 'Duration of foolproof_paths'
+)
+
 #----------------------------------------------------------------------------------------#
 #--------------------------------------------------------------------------- FUNCTIONS --#
 
@@ -193,11 +204,11 @@ def fix_color_mode(node):
     if is_color:
         set_attr(node, 'colorSpace', 'sRGB', 'string')
         set_attr(node, 'alphaIsLuminance', False)
-        log(f'Set {name}\'s color mode to BaseColor')
+        log('Set %s\'s color mode to BaseColor', name)
     else:
         set_attr(node, 'colorSpace', 'Raw', 'string')
         set_attr(node, 'alphaIsLuminance', True)
-        log(f'Set {name}\'s color mode to Raw')
+        log('Set %s\'s color mode to Raw', name)
 
     return True
 #endregion
@@ -214,18 +225,23 @@ def reference_asset(path: str):
         node = cmds.file(path, q=True, referenceNode=True)
         cmds.select(node)
         mel.eval(f'duplicateReference 0 ""')
-        log(f'Duplicated reference to {node}')
+        log('Duplicated reference to %s', node)
         return False
     except RuntimeError:
         # create reference
         cmds.file(path, reference=True)
-        log(f'Created reference to {path}')
+        log('Created reference to %s', path)
         return True
 
 
 def foolproof_paths(notify=True):
-    count = foolproof_user_references()
-    count += foolproof_file_nodes()
+    with _foolproof_seconds.time():
+        count_references = foolproof_user_references()
+        count_nodes = foolproof_file_nodes()
+    _paths_fixed.inc(count_references, kind='reference')
+    _paths_fixed.inc(count_nodes, kind='file_node')
+
+    count = count_references + count_nodes
     if notify:
         widgets.NotifyUser('Foolproof File Paths', f'Updated {count} file reference(s).')
     return count
@@ -279,14 +295,14 @@ def foolproof_user_reference(node):
 
     # validate new path
     if not os.path.isfile(path_ref_og):
-        log(f'unable to remove user from {node}\'s path: {path_ref_og} -> {path_ref}',
+        log('unable to remove user from %s\'s path: %s -> %s', node, path_ref_og, path_ref,
             level=Level.ERROR)
         return False
 
     # update the reference
     cmds.file(path_ref, loadReference=node)
     cmds.file(loadReference=node)
-    log(f'updated {node} to a user path ({path_ref})')
+    log('updated %s to a user path (%s)', node, path_ref)
 
     return True
 
@@ -315,13 +331,13 @@ def foolproof_file_node(node):
 
     # validate the new path
     if not os.path.isfile(path_og):
-        log(f'unable to remove user from {node}\'s path: {path_og} -> {path_new}',
+        log('unable to remove user from %s\'s path: %s -> %s', node, path_og, path_new,
             level=Level.ERROR)
         return False
 
     # update the file node
     cmds.setAttr(attr, path_new, type='string')
-    log(f'updated {node} to a user path ({path_new})')
+    log('updated %s to a user path (%s)', node, path_new)
     return True
 
 
@@ -371,6 +387,7 @@ class MayabatchExecuter(AppExecuter):
     def __init__(self, name=None, name_exe=None, path_exe=None):
         super().__init__(name, name_exe, path_exe)
         self._path_errors = None
+        self._env = None
 
     @classmethod
     def _get_exe_path(cls, name_exe: str) -> str:
@@ -381,7 +398,7 @@ class MayabatchExecuter(AppExecuter):
         return path if path else 'C:/Program Files/Autodesk/Maya2023/bin/mayabatch.exe'
 
     def _create_process(self, args, on_finish) -> Process:
-        return MayaProcess(self.NAME, self.path_exe, args, on_finish,
+        return MayaProcess(self.NAME, self.path_exe, args, on_finish, env=self._env,
                            path_errors=self._path_errors)
 
     def run(self, on_finish=notify_system, path_maya_file: str = None, command: str = None,
@@ -419,6 +436,11 @@ class MayabatchExecuter(AppExecuter):
         if not command:
             return None
 
+        # merge mayabatch's log into this session's log
+        job = f'{self.NAME} ({uuid4().hex[:8]})'
+        self._env = get_child_env(job)
+        log('Starting job %s', job)
+
         # make a file to write errors to
         # python errors in mayabatch are sent to stdout, so we need to do some trickery
         # to extract errors from it
@@ -491,7 +513,7 @@ class SurfacingUtils:
         :type: dict[str, list[str]]
         """
         if not cmds.objExists(obj):
-            log(f'{obj} does not exist.')
+            log('%s does not exist.', obj)
             return None
 
         # get the shaders obj (and it's children) use
@@ -539,7 +561,7 @@ class SurfacingUtils:
         type: dict[str, list[str]]
         """
         if not cmds.objExists(obj):
-            log(f'{obj} does not exist.')
+            log('%s does not exist.', obj)
             return None
 
         updated = {}
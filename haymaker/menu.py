@@ -62,13 +62,19 @@ def create_menu():
 
 
 def _add_item(parent, label, command):
-    log_injection = f'from haymaker.log import log; log("Menu - {label}"); '
-    cmds.menuItem(parent=parent, label=label, command=log_injection + command)
+    # log the tool, and time it (see haymaker.log_query --spans)
+    log_injection = f'from haymaker.log import log, span; log("Menu - {label}")\n'
+    span_injection = f'with span("Menu - {label}"): '
+    cmds.menuItem(parent=parent, label=label,
+                  command=log_injection + span_injection + command)
 
 
 def create_general(parent):
     _add_item(parent, 'Version Current File',
               'from haymaker.utils import version_file; version_file()')
+    _add_item(parent, 'Version Store Report',
+              'from haymaker.utils import report_scene_version_store; '
+              'report_scene_version_store()')
     _add_item(parent, 'Foolproof File paths',
               'from haymaker.maya import foolproof_paths; foolproof_paths()')
     _add_item(parent, 'Delete Unknown Nodes',
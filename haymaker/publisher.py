@@ -27,8 +27,22 @@ import maya.cmds as cmds
 # Internal
 from haymaker.maya import get_active_file_path
 from haymaker.widgets import NotifyUser
-from haymaker.log import log, Level
+from haymaker.log import counter, histogram, log, Level
 from haymaker.maya import MayabatchExecuter
+from haymaker.utils import mark_version_published, version_file
+
+#----------------------------------------------------------------------------------------#
+#----------------------------------------------------------------------------- GLOBALS --#
+
+_publishes = counter(
+    'haymaker_publishes_total', 'Animation publishes started', labels=('result',)
+)
+_publish_seconds = histogram(
+    'haymaker_publish_seconds', 'Time to prepare and start an animation publish'
+)
+_bytes_copied = counter(
+    'haymaker_bytes_copied_total', 'Bytes of files copied', labels=('operation',)
+)
 
 #----------------------------------------------------------------------------------------#
 #--------------------------------------------------------------------------- FUNCTIONS --#
@@ -81,7 +95,7 @@ def publish_animations(paths, max_batches=3):
     # for path in split_into_batches(paths, max_batches):
     for path in paths:
         if not path:
-            log(f'Please provide valid paths to publish: "{path}"', Level.WARN)
+            log('Please provide valid paths to publish: "%s"', path, level=Level.WARN)
         elif publish_animation(path):
             success.append(path)
         else:
@@ -96,11 +110,17 @@ def publish_animation(path_work=None):
 
     :return: success
     """
+    with _publish_seconds.time():
+        success = _publish_animation(path_work)
+    _publishes.inc(result='started' if success else 'failed')
+    return success
+
+
+def _publish_animation(path_work):
     # we were not given a file to publish because it's currently open
-    # make the current maya scene is ready to publish
+    # save the current maya scene as a new version to publish
     if not path_work:
-        cmds.file(save=True)
-        path_work = get_active_file_path()
+        path_work = version_file()
         if not path_work:
             NotifyUser(
                 title='Publish - Animation', notify_type=None,
@@ -108,10 +128,17 @@ def publish_animation(path_work=None):
             )
             return None
 
+    # retention keeps the version this is published from. an active file gets a new version,
+    # so the marked version is exactly what's published
+    path_version = mark_version_published(path_work)
+    if path_version:
+        path_work = path_version
+
     # make a copy of the current animation file that will be the publish file
     file_copy, path_copy = tempfile.mkstemp(suffix='.ma')
     os.close(file_copy)
     shutil.copy(path_work, path_copy)
+    _bytes_copied.inc(os.path.getsize(path_copy), operation='publish')
 
     # make next version folder
     name = os.path.basename(path_work).split('.')[0]
@@ -205,7 +232,7 @@ def _bg_publish_animation(path_publish):
             # be using. Import it.
             if loaded and (is_rig or has_cam):
                 cmds.file(path, importReference=True)
-                log(f'Import reference to {path}')
+                log('Import reference to %s', path)
                 continue
 
             # case 2: reference is unloaded, is a set, or is anything else. Delete it.
@@ -16,19 +16,92 @@
 #----------------------------------------------------------------------------- IMPORTS --#
 
 # Built-in
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from datetime import date
+from functools import partial
+import hashlib
 import json
 import os
+import secrets
 import shutil
+import threading
+from time import perf_counter
+
+try:
+    import fcntl
+except ImportError:
+    # windows
+    fcntl = None
 
 # 3rd Party
 try:
     from maya import cmds
+    from maya.utils import executeDeferred
     from haymaker.maya import foolproof_paths
 except ImportError:
     print('WARNING: Cannot import maya.cmds in this environment')
 
 # Internal
-from haymaker.log import log, Level
+from haymaker.formula_manager import Drive
+from haymaker.log import counter, histogram, log, Level, span
+
+#----------------------------------------------------------------------------------------#
+#----------------------------------------------------------------------------- GLOBALS --#
+
+_files_versioned = counter('haymaker_files_versioned_total', 'Files versioned')
+_version_seconds = histogram('haymaker_version_file_seconds', 'Duration of version_file')
+_bytes_copied = counter(
+    'haymaker_bytes_copied_total', 'Bytes of files copied', labels=('operation',)
+)
+_clone_seconds = histogram(
+    'haymaker_clone_file_seconds', 'Duration of clone_file', labels=('method',)
+)
+_bytes_deduplicated = counter(
+    'haymaker_bytes_deduplicated_total', 'Bytes of versions stored as links to a copy'
+)
+_versions_deleted = counter(
+    'haymaker_versions_deleted_total', 'Versions deleted by the retention policy'
+)
+_bytes_reclaimed = counter(
+    'haymaker_bytes_reclaimed_total', 'Bytes freed by the retention policy'
+)
+
+# files are copied in chunks of this many bytes when they can't be cloned (see clone_file)
+CLONE_CHUNK_SIZE = 8 * 1024 * 1024
+
+# version_file hard links the version to the active file instead of copying it. only turn
+# this on if saving replaces the active file rather than rewriting it in place, otherwise
+# the next save changes the version as well
+VERSION_HARD_LINK = False
+
+# versions are stored once per unique content: each version is a hard link to a file in
+# VERSION_STORE_DIR (named by its hash), in the same directory. see clone_file(dedupe)
+# and report_version_store. version_file also links a version to the previous one when
+# the scene hasn't changed since. filesystems without hard links get full copies
+VERSION_DEDUPE = False
+VERSION_STORE_DIR = '.versions'
+
+# names of versions that something was published from, one per line, next to the versions.
+# retention never deletes them, see mark_version_published
+VERSION_PUBLISHED_FILE = '.published'
+
+# linux ioctl that makes a copy-on-write clone of a file (btrfs, xfs, ...)
+_FICLONE = 0x40049409
+
+# directories are scanned in parallel by this many threads (see iter_latest_versions),
+# scanning a synced drive is mostly waiting on I/O
+VERSION_SCAN_WORKERS = 8
+
+# extensions of the versioned scenes that tree scans look at (see iter_latest_versions).
+# other files are named the same way, e.g. frames (shot010.0001.exr) and UDIM tiles
+# (body_BaseColor.1001.png), so they're only included when a caller asks for them
+VERSION_EXTS = ('ma', 'mb')
+
+# directories whose version index is kept between lookups (see get_latest_version), the
+# least recently used are dropped. tree scans don't keep theirs, a drive has far more
+VERSION_INDEX_CACHE_SIZE = 256
 
 #----------------------------------------------------------------------------------------#
 #--------------------------------------------------------------------------- FUNCTIONS --#
@@ -78,6 +151,269 @@ def write_json(path: str, data: dict, verbose: bool = True):
     return str_data
 
 
+def clone_file(path_src: str, path_dst: str, link=False, dedupe=False,
+               on_finish=None) -> str:
+    """
+    Copies a file the cheapest way available:
+        - hard link, if link is True. only when neither file will be modified in place
+        - reflink, a copy-on-write clone, on filesystems that support it
+        - otherwise the data is copied in a background thread, with copy_file_range where
+          the OS has it (in-kernel, server-side on network drives) or in chunks
+    The copy is written to a temp file next to path_dst and renamed when it's complete, so
+    path_dst never exists half-written. If path_src changes during the copy, the copy
+    fails. If something else writes path_dst during the copy (e.g. the scene is saved
+    again), the newer file is kept and the copy is dropped, the method is 'superseded'.
+
+    With dedupe, the data is hashed while it's copied and path_src is stored once per
+    unique content: it's replaced by a hard link to the file with the same content in
+    VERSION_STORE_DIR, or added there. The method is 'dedupe' when existing content was
+    reused. path_src must never be modified in place.
+
+    :param on_finish: called with (method, seconds, error or None) once the file exists,
+        from the copy's thread for background copies.
+    :return: the method used, 'link', 'reflink' or 'copy'
+    """
+    start = perf_counter()
+    state_dst = _get_file_state(path_dst)
+
+    def finish(method, error=None):
+        seconds = perf_counter() - start
+        _clone_seconds.observe(seconds, method=method)
+        if on_finish:
+            on_finish(method, seconds, error)
+
+    if link and not dedupe:
+        path_temp = _get_temp_path(path_dst)
+        try:
+            os.link(path_src, path_temp)
+            os.replace(path_temp, path_dst)
+            finish('link')
+            return 'link'
+        except OSError:
+            _remove_temp(path_temp)
+
+    if fcntl and not dedupe:
+        path_temp = _get_temp_path(path_dst)
+        try:
+            with open(path_src, 'rb') as file_src, open(path_temp, 'xb') as file_dst:
+                fcntl.ioctl(file_dst.fileno(), _FICLONE, file_src.fileno())
+            os.replace(path_temp, path_dst)
+            finish('reflink')
+            return 'reflink'
+        except OSError:
+            _remove_temp(path_temp)
+
+    def copy():
+        method = 'copy'
+        error = None
+        # unique per copy, so two copies to the same file can't write over each other
+        path_temp = _get_temp_path(path_dst)
+        try:
+            stat = os.stat(path_src)
+            hasher = hashlib.sha256() if dedupe else None
+            _copy_file_data(path_src, path_temp, stat.st_size, hasher)
+            if _get_file_state(path_src) != (stat.st_size, stat.st_mtime_ns):
+                raise OSError(f'{path_src} changed while it was being copied')
+            if dedupe and _link_from_store(path_src, hasher.hexdigest()):
+                method = 'dedupe'
+                _bytes_deduplicated.inc(stat.st_size)
+            elif dedupe:
+                _add_to_store(path_src, hasher.hexdigest())
+
+            if _get_file_state(path_dst) != state_dst:
+                method = 'superseded'
+                _remove_temp(path_temp)
+            else:
+                os.replace(path_temp, path_dst)
+                _bytes_copied.inc(stat.st_size, operation='clone')
+        except OSError as e:
+            error = e
+            _remove_temp(path_temp)
+        finish(method, error)
+
+    # not a daemon, so the interpreter waits for the copy before exiting
+    threading.Thread(target=copy, name='haymaker.clone_file').start()
+    return 'copy'
+
+
+def _get_file_state(path: str):
+    # (size, mtime) changes whenever the file is written, None if there is no file
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _get_temp_path(path: str) -> str:
+    # not a number before the extension, so it's never mistaken for a version
+    return f'{path}.tmp-{secrets.token_hex(4)}.part'
+
+
+def _remove_temp(path_temp: str):
+    try:
+        os.remove(path_temp)
+    except OSError:
+        pass
+
+
+def _copy_file_data(path_src: str, path_dst: str, size: int, hasher=None):
+    # hasher (hashlib) is updated with the data, which needs it to go through python
+    with open(path_src, 'rb') as file_src, open(path_dst, 'xb') as file_dst:
+        if hasattr(os, 'copy_file_range') and hasher is None:
+            try:
+                copied = 0
+                while copied < size:
+                    count = os.copy_file_range(
+                        file_src.fileno(), file_dst.fileno(), CLONE_CHUNK_SIZE
+                    )
+                    if not count:
+                        break
+                    copied += count
+                return
+            except OSError:
+                # not supported between these filesystems, start over in chunks
+                file_src.seek(0)
+                file_dst.seek(0)
+                file_dst.truncate()
+
+        buffer = bytearray(CLONE_CHUNK_SIZE)
+        view = memoryview(buffer)
+        while True:
+            count = file_src.readinto(buffer)
+            if not count:
+                break
+            file_dst.write(view[:count])
+            if hasher is not None:
+                hasher.update(view[:count])
+
+
+def _get_store_path(path: str, digest: str) -> str:
+    ext = os.path.splitext(path)[1]
+    return os.path.join(os.path.dirname(path), VERSION_STORE_DIR, f'{digest}{ext}')
+
+
+def _link_from_store(path: str, digest: str) -> bool:
+    """
+    Replaces path with a link to the stored file with this content, if there is one.
+
+    :return: success
+    """
+    path_object = _get_store_path(path, digest)
+    if not os.path.isfile(path_object):
+        return False
+    path_temp = _get_temp_path(path)
+    try:
+        os.link(path_object, path_temp)
+        os.replace(path_temp, path)
+        return True
+    except OSError:
+        # no hard links on this drive, keep the copy
+        _remove_temp(path_temp)
+        return False
+
+
+def _add_to_store(path: str, digest: str):
+    path_object = _get_store_path(path, digest)
+    try:
+        os.makedirs(os.path.dirname(path_object), exist_ok=True)
+        os.link(path, path_object)
+    except OSError:
+        # no hard links, or another process stored the same content first
+        pass
+
+
+def report_version_store(root: str = None, prune=False, workers: int = None) -> dict:
+    """
+    Logs how much space the deduplicated version store (see VERSION_DEDUPE) saves under
+    root. Stored files that no version links to anymore are orphans, prune removes them.
+    Directories are scanned by a pool of threads, like iter_latest_versions.
+
+    :param root: directory to search, the Box drive by default.
+    :param workers: number of threads, VERSION_SCAN_WORKERS by default.
+    :return: {'objects', 'versions', 'bytes_stored', 'bytes_saved', 'orphans',
+        'bytes_orphaned'}
+    """
+    root = os.path.abspath(os.path.expanduser(root or Drive.BOX.value))
+    report = _get_version_store_report(root, prune, workers)
+    _log_version_store_report(root, report, prune)
+    return report
+
+
+def report_scene_version_store():
+    """
+    Runs report_version_store in the background, for the current scene's directory (the
+    Box drive if the scene isn't saved). The report is logged once it's done.
+    """
+    path_scene = cmds.file(q=True, sceneName=True)
+    root = os.path.abspath(os.path.dirname(path_scene) if path_scene else Drive.BOX.value)
+
+    def report():
+        errors = []
+        data = _get_version_store_report(root, errors=errors)
+        # Maya's console is only safe on the main thread
+        executeDeferred(partial(_log_version_store_report, root, data, errors=errors))
+
+    log('Scanning the version store under %s...', root)
+    threading.Thread(target=report, name='haymaker.version_store', daemon=True).start()
+
+
+_STORE_REPORT_KEYS = (
+    'objects', 'versions', 'bytes_stored', 'bytes_saved', 'orphans', 'bytes_orphaned'
+)
+def _get_version_store_report(root: str, prune=False, workers: int = None,
+                              errors: list = None) -> dict:
+    report = dict.fromkeys(_STORE_REPORT_KEYS, 0)
+    process = partial(_report_store_directory, prune)
+    for _, directory_report in _iter_version_indexes(root, workers, process, errors):
+        for key, value in directory_report.items():
+            report[key] += value
+    return report
+
+
+def _report_store_directory(prune: bool, index: '_VersionIndex') -> dict:
+    report = dict.fromkeys(_STORE_REPORT_KEYS, 0)
+    try:
+        entries = list(os.scandir(os.path.join(index.directory, VERSION_STORE_DIR)))
+    except OSError:
+        return report
+
+    for entry in entries:
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        if not entry.is_file() or entry.name.endswith('.part'):
+            continue
+
+        # one link is the store's own
+        links = stat.st_nlink - 1
+        if links < 1:
+            report['orphans'] += 1
+            report['bytes_orphaned'] += stat.st_size
+            if prune:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+            continue
+
+        report['objects'] += 1
+        report['versions'] += links
+        report['bytes_stored'] += stat.st_size
+        report['bytes_saved'] += stat.st_size * (links - 1)
+    return report
+
+
+def _log_version_store_report(root: str, report: dict, prune=False, errors=()):
+    for error in errors:
+        log('Unable to scan for versions :: %s', error, level=Level.WARN)
+    log('Version store under %s: %s versions share %s files (%.1f MB), saving %.1f MB. '
+        '%s orphaned files (%.1f MB)%s', root, report['versions'], report['objects'],
+        report['bytes_stored'] / 1e6, report['bytes_saved'] / 1e6, report['orphans'],
+        report['bytes_orphaned'] / 1e6, ' removed' if prune else '')
+
+
 def normalize_path(path: str):
     return os.path.normpath(path).replace('\\', '/')
 
@@ -123,41 +459,210 @@ def get_version(path):
     return None
 
 
-def get_versions(path):
-    path_split = path.split('.')
-    if len(path_split) <= 1:
-        log(f'path is wack!!!', level=Level.ERROR)
+def split_version_name(name: str):
+    """
+    Splits a file name into its base name, version and extension, following the rules of
+    get_version and get_active_path.
+        Warehouse.0003.ma -> ('Warehouse', 3, 'ma')
+        Warehouse.active.ma -> ('Warehouse', None, 'ma')
+
+    :return: (base, version or None, ext), or None if the name has no extension
+    """
+    name_split = name.split('.')
+    if len(name_split) <= 1:
         return None
 
-    if len(path_split) > 2:
+    if len(name_split) > 2:
         try:
-            path_split = path_split[:-2] + path_split[-1:]
+            return '.'.join(name_split[:-2]), int(name_split[-2]), name_split[-1]
         except ValueError:
-            pass
-    path = '.'.join(path_split)
+            if name_split[-2] == 'active':
+                return '.'.join(name_split[:-2]), None, name_split[-1]
+
+    return '.'.join(name_split[:-1]), None, name_split[-1]
 
-    versions = []
-    for entry in os.scandir(os.path.dirname(path)):
-        if not entry.is_file():
-            continue
 
-        version = get_version(entry.name)
-        if version is not None:
-            versions.append((entry.path, version))
+def get_versions(path):
+    """
+    :return: [(path, version), ...] of the versions of path's file, oldest first.
+    """
+    key = _get_version_key(path)
+    if not key:
+        log(f'path is wack!!!', level=Level.ERROR)
+        return None
 
-    return versions
+    directory, base, ext = key
+    versions = _get_version_index(directory).versions.get((base, ext), {})
+    return [(versions[version], version) for version in sorted(versions)]
 
 
 def get_latest_version(path):
-    versions = get_versions(path)
-    if not versions:
+    key = _get_version_key(path)
+    if not key:
+        return None
+
+    directory, base, ext = key
+    index = _get_version_index(directory)
+    version = index.latest.get((base, ext))
+    if version is None:
+        return None
+    return index.versions[(base, ext)][version]
+
+
+def get_next_version_path(path):
+    """
+    :return: path for the version after the latest version of path's file.
+    """
+    key = _get_version_key(path)
+    if not key:
+        log(f'path is wack!!!', level=Level.ERROR)
         return None
 
-    latest = versions[0]
-    for version in versions:
-        if version[1] > latest[1]:
-            latest = version
-    return latest[0]
+    directory, base, ext = key
+    version = _get_version_index(directory).latest.get((base, ext), 0) + 1
+    return os.path.join(directory, f'{base}.{version:04}.{ext}').replace('\\', '/')
+
+
+def iter_latest_versions(root: str = None, exts=VERSION_EXTS, workers: int = None):
+    """
+    Finds the latest version of every versioned file (name.NNNN.ext) under root. Each
+    directory is scanned once, by a pool of threads, and results are yielded as soon as
+    their directory has been scanned.
+        for path, (path_latest, version, path_active) in iter_latest_versions(root):
+            ...
+
+    :param root: directory to search, the Box drive by default.
+    :param exts: only files with these extensions, VERSION_EXTS by default.
+    :param workers: number of threads, VERSION_SCAN_WORKERS by default.
+    :return: yields (base path, (latest version path, version, active path))
+        base path is the file's path without a version, dir/name.ext
+    """
+    exts = set(exts or VERSION_EXTS)
+    for index, _ in _iter_version_indexes(root, workers):
+        directory = index.directory.replace('\\', '/')
+        for (base, ext), version in index.latest.items():
+            if ext not in exts:
+                continue
+            yield f'{directory}/{base}.{ext}', (
+                index.versions[(base, ext)][version],
+                version,
+                f'{directory}/{base}.active.{ext}',
+            )
+
+
+def get_latest_versions(root: str = None, exts=VERSION_EXTS,
+                        workers: int = None) -> dict:
+    """
+    See iter_latest_versions.
+
+    :return: {base path: (latest version path, version, active path)}
+    """
+    return dict(iter_latest_versions(root, exts, workers))
+
+
+def _iter_version_indexes(root: str = None, workers: int = None, process=None,
+                          errors: list = None):
+    """
+    Scans every directory under root for versions, with a pool of threads.
+
+    :param process: optional function run on each _VersionIndex, in the pool.
+    :param errors: directories that can't be scanned are added to it instead of logged,
+        for callers off the main thread.
+    :return: yields (_VersionIndex, process' result) as each directory is done.
+    """
+    root = os.path.abspath(os.path.expanduser(root or Drive.BOX.value))
+    pool = ThreadPoolExecutor(workers or VERSION_SCAN_WORKERS, 'haymaker.versions')
+    pending = {pool.submit(_scan_version_directory, root, process)}
+    try:
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    index, directories, result = future.result()
+                except OSError as e:
+                    if errors is not None:
+                        errors.append(e)
+                    else:
+                        log('Unable to scan for versions :: %s', e, level=Level.WARN)
+                    continue
+                pending.update(
+                    pool.submit(_scan_version_directory, directory, process)
+                    for directory in directories
+                )
+                yield index, result
+    finally:
+        # stopped early, don't bother with the rest of the tree
+        for future in pending:
+            future.cancel()
+        pool.shutdown()
+
+
+def _scan_version_directory(directory: str, process=None):
+    mtime_ns = os.stat(directory).st_mtime_ns
+    index = _VersionIndex(directory, mtime_ns)
+    directories = index.scan()
+    return index, directories, process(index) if process else None
+
+
+def _get_version_key(path):
+    split = split_version_name(os.path.basename(path))
+    if not split:
+        return None
+    base, _, ext = split
+    return os.path.abspath(os.path.dirname(path)), base, ext
+
+
+# directory -> _VersionIndex, least recently used first
+_version_indexes = OrderedDict()
+_version_indexes_lock = threading.Lock()
+def _get_version_index(directory: str) -> '_VersionIndex':
+    # the directory's mtime changes whenever a file is added, removed or renamed in it
+    try:
+        mtime_ns = os.stat(directory).st_mtime_ns
+    except OSError:
+        return _VersionIndex(directory, None)
+
+    with _version_indexes_lock:
+        index = _version_indexes.get(directory)
+        if index is not None and index.mtime_ns == mtime_ns:
+            _version_indexes.move_to_end(directory)
+            return index
+
+    index = _VersionIndex(directory, mtime_ns)
+    index.scan()
+    with _version_indexes_lock:
+        _version_indexes[directory] = index
+        _version_indexes.move_to_end(directory)
+        while len(_version_indexes) > VERSION_INDEX_CACHE_SIZE:
+            _version_indexes.popitem(last=False)
+    return index
+
+
+def _remove_version_from_index(path, mtime_ns: int):
+    # patch the index of a directory we just deleted a version from, instead of rescanning
+    # it. only if the index was up to date right before the delete (mtime_ns), otherwise
+    # stamping the directory's new mtime would hide whatever else changed it
+    directory = os.path.abspath(os.path.dirname(path))
+    with _version_indexes_lock:
+        index = _version_indexes.get(directory)
+        if index is None:
+            return
+        try:
+            if index.mtime_ns != mtime_ns:
+                raise OSError('changed since indexed')
+            index.mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError:
+            del _version_indexes[directory]
+            return
+        index.remove(os.path.basename(path))
+
+
+def _forget_version_index(path):
+    # a save can take seconds and Box can sync other files in meanwhile, so the index of a
+    # directory we saved a version to is dropped and scanned again on next use
+    directory = os.path.abspath(os.path.dirname(path))
+    with _version_indexes_lock:
+        _version_indexes.pop(directory, None)
 
 
 def get_active_path(path):
@@ -178,6 +683,16 @@ def get_active_path(path):
 
 
 def version_file():
+    """
+    Saves the scene as its next version and updates the active file from it.
+
+    :return: path of the version, None if the scene couldn't be versioned.
+    """
+    with _version_seconds.time():
+        return _version_file()
+
+
+def _version_file():
     path_file = cmds.file(q=True, sceneName=True)
     if not path_file:
         log(f'the scene needs to be saved before it can be versioned.', level=Level.ERROR)
@@ -185,26 +700,328 @@ def version_file():
 
     # get active and version path
     path_active = get_active_path(path_file)
-    path_version = get_latest_version(path_file)
-    if not path_version:
-        path_version = path_active
-    path_version = increment_version_path(path_version)
+    path_version = get_next_version_path(path_file)
+
+    # fix references before saving, so the file is only written once
+    with span('foolproof_paths'):
+        foolproof_paths(notify=False)
+
+    # nothing changed since the last version, it's linked instead of saved again. saving
+    # can't be deduplicated by content, Maya writes the name and time into the file
+    if VERSION_DEDUPE and not cmds.file(q=True, modified=True):
+        path_previous = _link_unchanged_version(path_active, path_version)
+        if path_previous:
+            log('Scene unchanged since %s, linked version %s', path_previous, path_version)
+            return path_version
+
+    # save the version. it's never written again, so the active file can be copied from it
+    # in the background without the next save getting in the way. the scene is renamed
+    # back even if the save fails, or the next save would write over the version
+    with span('save'):
+        cmds.file(rename=path_version)
+        try:
+            cmds.file(save=True)
+        finally:
+            cmds.file(rename=path_active)
+    _forget_version_index(path_version)
+    _files_versioned.inc()
+
+    # then the active file, a copy of the version
+    with span('clone'):
+        method = clone_file(
+            path_version, path_active, link=VERSION_HARD_LINK, dedupe=VERSION_DEDUPE,
+            on_finish=partial(_on_active_cloned, path_version, path_active)
+        )
+    log('Saved version %s, updating active %s (%s)', path_version, path_active, method)
+    return path_version
+
+
+# active path -> (version it was cloned from, the active file's (size, mtime) after)
+_active_versions = {}
+def _link_unchanged_version(path_active: str, path_version: str):
+    """
+    Links path_version to the version the active file was last cloned from, if the active
+    file hasn't been written since (the scene isn't modified either, see _version_file).
+
+    :return: the linked version, None if the scene has to be saved.
+    """
+    path_previous, state = _active_versions.get(path_active, (None, None))
+    if not path_previous or _get_file_state(path_active) != state:
+        return None
+    try:
+        os.link(path_previous, path_version)
+    except OSError:
+        # gone, or no hard links on this drive
+        return None
+    _active_versions[path_active] = (path_version, state)
+    _forget_version_index(path_version)
+    _files_versioned.inc()
+    _bytes_deduplicated.inc(state[0])
+    return path_previous
+
 
-    # save active file
-    cmds.file(rename=path_active)
-    cmds.file(save=True)
+def _on_active_cloned(path_version, path_active, method, seconds, error):
+    if not error and method != 'superseded':
+        _active_versions[path_active] = (path_version, _get_file_state(path_active))
+    # can be called from the copy's thread, Maya's console is only safe on the main thread
+    executeDeferred(partial(
+        _log_active_cloned, path_version, path_active, method, seconds, error
+    ))
 
-    # slip in reference fixing
-    foolproof_paths(notify=False)
-    cmds.file(save=True)
 
-    # save a version too
-    shutil.copy(path_active, path_version)
-    log(f'Saved active to {path_active} and version to {path_version}')
-    return True
+def _log_active_cloned(path_version, path_active, method, seconds, error):
+    if error:
+        log('Unable to update active %s from %s :: %s', path_active, path_version, error,
+            level=Level.ERROR)
+    elif method == 'superseded':
+        log('Active %s was saved again before it was updated from %s', path_active,
+            path_version)
+    else:
+        log('Updated active %s (%s, %.2fs)', path_active, method, seconds)
+
+
+def mark_version_published(path: str):
+    """
+    Records that a version was published from, so retention never deletes it. Active
+    files are copied to a new version first, the latest version may not have the same
+    content.
+
+    :return: path of the marked version, None if there isn't one.
+    """
+    split = split_version_name(os.path.basename(path))
+    if split and split[1] is None:
+        path_version = get_next_version_path(path)
+        if not path_version:
+            return None
+        try:
+            shutil.copy2(path, path_version)
+        except OSError as e:
+            log('Unable to version %s for publishing :: %s', path, e, level=Level.WARN)
+            return None
+        _forget_version_index(path_version)
+        path = path_version
+    path_published = os.path.join(os.path.dirname(path), VERSION_PUBLISHED_FILE)
+    try:
+        with open(path_published, 'a') as file:
+            file.write(f'{os.path.basename(path)}\n')
+    except OSError as e:
+        log('Unable to mark %s as published :: %s', path, e, level=Level.WARN)
+        return None
+    return path
+
+
+def plan_version_retention(root: str = None, policy: 'RetentionPolicy' = None,
+                           exts=VERSION_EXTS, workers: int = None) -> 'RetentionPlan':
+    """
+    Works out which versions under root the policy would delete, and how much space
+    that frees. Versions that share their data (hard links, see VERSION_DEDUPE) only
+    count once the last of them goes.
+
+    :param root: directory to search, the Box drive by default.
+    :param exts: only versions with these extensions, VERSION_EXTS by default. frames
+        and UDIM tiles look like versions too, so only add extensions of versioned files.
+    """
+    policy = policy or RetentionPolicy()
+    process = partial(_plan_directory, policy, set(exts or VERSION_EXTS), date.today())
+    plan = RetentionPlan()
+    for _, plan_directory in _iter_version_indexes(root, workers, process):
+        plan.extend(plan_directory)
+    return plan
+
+
+def apply_version_retention(root: str = None, policy: 'RetentionPolicy' = None,
+                            exts=VERSION_EXTS, dry_run=True,
+                            workers: int = None) -> 'RetentionPlan':
+    """
+    Deletes the versions the policy doesn't keep, see plan_version_retention. Deletes run
+    in a pool of threads. Nothing is deleted with dry_run, the plan is just logged.
+    """
+    plan = plan_version_retention(root, policy, exts, workers)
+    if dry_run:
+        log('Retention would delete %s versions (keeping %s), freeing %.1f MB',
+            len(plan.delete), plan.kept, plan.bytes_reclaimed / 1e6)
+        return plan
+
+    def delete(path):
+        try:
+            mtime_ns = os.stat(os.path.dirname(path) or '.').st_mtime_ns
+            os.remove(path)
+        except OSError as e:
+            log('Unable to delete %s :: %s', path, e, level=Level.WARN)
+            return False
+        _remove_version_from_index(path, mtime_ns)
+        return True
+
+    workers = workers or VERSION_SCAN_WORKERS
+    with ThreadPoolExecutor(workers, 'haymaker.retention') as pool:
+        deleted = sum(pool.map(delete, plan.delete))
+    _versions_deleted.inc(deleted)
+    _bytes_reclaimed.inc(plan.bytes_reclaimed)
+    log('Retention deleted %s of %s versions (keeping %s), freeing %.1f MB', deleted,
+        len(plan.delete), plan.kept, plan.bytes_reclaimed / 1e6)
+    return plan
+
+
+def _plan_directory(policy: 'RetentionPolicy', exts, today: date,
+                    index: '_VersionIndex') -> 'RetentionPlan':
+    plan = RetentionPlan()
+    if not index.versions:
+        return plan
+
+    published = set()
+    if policy.keep_published:
+        try:
+            with open(os.path.join(index.directory, VERSION_PUBLISHED_FILE)) as file:
+                published = set(file.read().split())
+        except OSError:
+            pass
+
+    # stored content (see VERSION_DEDUPE) by inode, it goes with its last version
+    store = {}
+    try:
+        with os.scandir(os.path.join(index.directory, VERSION_STORE_DIR)) as it:
+            for entry in it:
+                store[entry.inode()] = entry.path
+    except OSError:
+        pass
+
+    deleted_links = {}
+    for (base, ext), versions in index.versions.items():
+        if ext not in exts:
+            continue
+
+        days = set()
+        weeks = set()
+        for i, version in enumerate(sorted(versions, reverse=True)):
+            path = versions[version]
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            day = date.fromtimestamp(stat.st_mtime)
+            week = day.isocalendar()[:2]
+            age = (today - day).days
+
+            keep = i < max(1, policy.keep_last)
+            if policy.keep_published and os.path.basename(path) in published:
+                keep = True
+            if age < policy.keep_daily and day not in days:
+                days.add(day)
+                keep = True
+            if age < policy.keep_weekly * 7 and week not in weeks:
+                weeks.add(week)
+                keep = True
+
+            if keep:
+                plan.kept += 1
+                continue
+            plan.delete.append(path)
+            # [links to this data, size, links deleted]
+            links = deleted_links.setdefault(
+                stat.st_ino, [stat.st_nlink, stat.st_size, 0]
+            )
+            links[2] += 1
+
+    for inode, (links, size, deleted) in deleted_links.items():
+        if deleted == links:
+            plan.bytes_reclaimed += size
+        elif inode in store and deleted == links - 1:
+            plan.delete.append(store[inode])
+            plan.bytes_reclaimed += size
+
+    return plan
 #endregion
 
 
+#----------------------------------------------------------------------------------------#
+#----------------------------------------------------------------------------- CLASSES --#
+
+
+class _VersionIndex:
+    """
+    The versioned files (name.NNNN.ext) in a directory, grouped by (base name, extension).
+    See _get_version_index.
+    """
+    __slots__ = ('directory', 'mtime_ns', 'versions', 'latest')
+
+    def __init__(self, directory: str, mtime_ns):
+        self.directory = directory
+        self.mtime_ns = mtime_ns
+        self.versions = {}  # (base, ext) -> {version: path}
+        self.latest = {}  # (base, ext) -> version
+
+    def scan(self) -> list:
+        """
+        :return: paths of the subdirectories, found along the way.
+        """
+        directories = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.is_file():
+                    self.add(entry.name)
+                elif entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith('.'):
+                        directories.append(entry.path)
+        return directories
+
+    def add(self, name: str):
+        split = split_version_name(name)
+        if not split or split[1] is None:
+            return
+        base, version, ext = split
+        key = (base, ext)
+        path = os.path.join(self.directory, name).replace('\\', '/')
+        self.versions.setdefault(key, {})[version] = path
+        if version > self.latest.get(key, -1):
+            self.latest[key] = version
+
+    def remove(self, name: str):
+        split = split_version_name(name)
+        if not split or split[1] is None:
+            return
+        base, version, ext = split
+        key = (base, ext)
+        versions = self.versions.get(key, {})
+        versions.pop(version, None)
+        if not versions:
+            self.versions.pop(key, None)
+            self.latest.pop(key, None)
+        elif self.latest[key] == version:
+            self.latest[key] = max(versions)
+
+
+@dataclass
+class RetentionPolicy:
+    """
+    Which versions of a file to keep, see plan_version_retention. A version is kept if
+    any rule keeps it. Days and weeks are counted back from today, keeping the newest
+    version of each.
+    """
+    keep_last: int = 5
+    keep_daily: int = 7
+    keep_weekly: int = 4
+    keep_published: bool = True
+
+
+@dataclass
+class RetentionPlan:
+    """
+    Versions to delete, see plan_version_retention.
+    """
+    delete: [str] = field(default_factory=list)
+    kept: int = 0
+    bytes_reclaimed: int = 0
+
+    def extend(self, other: 'RetentionPlan'):
+        self.delete.extend(other.delete)
+        self.kept += other.kept
+        self.bytes_reclaimed += other.bytes_reclaimed
+
+
+#----------------------------------------------------------------------------------------#
+#-------------------------------------------------------------------------------- MAIN --#
+
+
 def main():
     path_file = 'C:/Users/Nick/Box/Capstone_Uploads/05_Surfacing/SceneUploads/Warehouse.active.ma'
     path_active = get_active_path(path_file)
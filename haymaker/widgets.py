@@ -171,7 +171,7 @@ class Dialog(QtWidgets.QDialog):
             if os.path.isfile(icon_path):
                 self.setWindowIcon(QtGui.QIcon(icon_path))
             else:
-                log(f'Unable to find icon at {icon_path}', Level.ERROR)
+                log(f'Unable to find icon at {icon_path}', level=Level.ERROR)
 
         # config the help and close button
         self.setWindowFlag(QtCore.Qt.WindowContextHelpButtonHint, False)
@@ -186,7 +186,7 @@ class Dialog(QtWidgets.QDialog):
         elif self.window_mode == WindowMode.Exec:
             self.exec_()
         else:
-            log(f'unknown window mode {self.window_mode}', Level.ERROR)
+            log(f'unknown window mode {self.window_mode}', level=Level.ERROR)
 
 
 class NotifyUser(Dialog):
@@ -356,7 +356,7 @@ class Label(QtWidgets.QLabel):
             path_img = get_resource_path(name, self.resolution)
 
         if not os.path.isfile(path_img):
-            log(f'could not find image at {path_img}', Level.ERROR)
+            log(f'could not find image at {path_img}', level=Level.ERROR)
             self.pixel_map = None
             self.setPixmap(self.pixel_map)
             return None
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+#SETMODE 777
+
+#----------------------------------------------------------------------------------------#
+#------------------------------------------------------------------------------ HEADER --#
+
+"""
+:author:
+    Nick Maclean
+
+:synopsis:
+    Tests for FormulaRepo. Formulas are compiled, linked and partly inlined ahead of
+    time, so eval, eval_many and match are checked against the original resolution
+    rules (_reference_eval): reserved keywords first (overridable from kwargs), then
+    kwargs, then formulas, with |var| in any value resolved again.
+
+    python -m pytest tests
+"""
+
+#----------------------------------------------------------------------------------------#
+#----------------------------------------------------------------------------- IMPORTS --#
+
+# Built-In
+import json
+import os
+
+# Third Party
+import pytest
+
+# Internal
+from haymaker.formula_manager import (
+    Disk, Drive, FormulaArgumentError, FormulaCycleError, FormulaEvaluationError,
+    FormulaNotFoundError, FormulaRepo
+)
+
+#----------------------------------------------------------------------------------------#
+#----------------------------------------------------------------------------- GLOBALS --#
+
+FORMULAS = {
+    'd_logs': '|code|/logs',
+    'f_log': '|d_logs|/|user|/|name|',
+    'f_log_report': '|d_logs|/report.md',
+    'd_asset_library': '|config|/asset_library',
+    'f_asset_catalog': '|d_asset_library|/catalog.json',
+    'd_shot_dir': '|drive|/shots/|seq|/|shot|',
+    'f_shot_version': '|d_shot_dir|/|seq|_|shot|.|version|.|ext|',
+    'f_shot_log': '|f_log|.|shot|',
+    'f_box_file': '|box|/|name|',
+}
+
+CASES = [
+    ('d_logs', {}),
+    ('logs', {}),
+    ('f_log', {'user': 'nick', 'name': 'a.log'}),
+    ('f_log_report', {}),
+    ('f_asset_catalog', {}),
+    ('f_shot_version', {'seq': 's01', 'shot': '010', 'version': '0003', 'ext': 'ma'}),
+    ('f_shot_log', {'user': 'nick', 'name': 'a.log', 'shot': '010'}),
+    ('f_box_file', {'name': 'a.ma'}),
+
+    # reserved overrides
+    ('f_log', {'user': 'nick', 'name': 'a.log', 'disk': Disk.CONFIG}),
+    ('f_asset_catalog', {'disk': Disk.CODE}),
+    ('f_log_report', {'drive': Drive.BOX}),
+    ('f_box_file', {'name': 'a.ma', 'drive': Drive.BOX}),
+
+    # formula names as kwargs replace the formula
+    ('f_log', {'user': 'nick', 'name': 'a.log', 'd_logs': '/tmp/logs'}),
+    ('f_shot_log', {'f_log': '/tmp/x.log', 'shot': '010'}),
+    ('f_shot_version', {
+        'd_shot_dir': '/tmp/shot', 'seq': 's01', 'shot': '010', 'version': '0001',
+        'ext': 'ma',
+    }),
+    # the unprefixed name isn't a variable of the formula
+    ('f_log', {'user': 'nick', 'name': 'a.log', 'logs': '/tmp/logs'}),
+
+    # values with variables of their own
+    ('f_log', {'user': '|seq|', 'seq': 's01', 'name': 'a.log'}),
+    ('f_log', {'user': 'nick', 'name': '|d_asset_library|/a.log'}),
+    ('f_log', {'user': '|config|', 'name': 'a.log', 'disk': Disk.CONFIG}),
+    ('f_log', {'user': 'nick', 'name': 'a.log', 'd_logs': '|config|/old_logs'}),
+    ('f_shot_log', {'user': 'nick', 'name': '|shot|.log', 'shot': '|seq|', 'seq': 's02'}),
+]
+
+#----------------------------------------------------------------------------------------#
+#--------------------------------------------------------------------------- FUNCTIONS --#
+
+
+def _load(tmp_path, formulas: dict = None, **kwargs) -> FormulaRepo:
+    path = tmp_path / 'formulas.json'
+    path.write_text(json.dumps({
+        'formulas': FORMULAS if formulas is None else formulas,
+        'formula_prefixes': ['d', 'f'],
+    }))
+    return FormulaRepo.load(str(path), use_cache=False, **kwargs)
+
+
+def _reference_eval(repo: FormulaRepo, formula_name: str, **kwargs) -> str:
+    """
+    FormulaRepo.eval as it was before formulas were compiled: the formula text is
+    scanned for |variable| on every call.
+    """
+    def remove_prefix(s):
+        prefix, separator, name = s.partition('_')
+        if separator and prefix in repo.formula_prefixes:
+            return name
+        return s
+
+    def resolve(variable):
+        for keyword in repo.RESERVED_KEYWORDS:
+            if value := keyword.try_to_resolve(variable, **kwargs):
+                return value
+        if variable in kwargs:
+            return kwargs[variable]
+        if (formula := repo.formulas.get(remove_prefix(variable))) is not None:
+            return evaluate(formula)
+        raise FormulaArgumentError(f'eval() is missing an argument for {variable}.')
+
+    def evaluate(formula):
+        resolved = ''
+        variable = None
+        for c in formula:
+            if c == '|':
+                if variable is None:
+                    variable = ''
+                else:
+                    resolved += evaluate(resolve(variable))
+                    variable = None
+                continue
+            if variable is None:
+                resolved += c
+            else:
+                variable += c
+        if variable is not None:
+            raise FormulaEvaluationError(f"Missing closing '|' in {formula}")
+        return resolved
+
+    formula_name = remove_prefix(formula_name)
+    if formula_name not in repo.formulas:
+        raise FormulaNotFoundError(f'Could not find a formula for {formula_name}.')
+    return evaluate(repo.formulas[formula_name])
+
+
+@pytest.mark.parametrize('cache_size', [None, 0])
+@pytest.mark.parametrize('formula_name, kwargs', CASES)
+def test_eval_matches_reference(tmp_path, formula_name, kwargs, cache_size):
+    repo = _load(tmp_path, cache_size=cache_size)
+    expected = _reference_eval(repo, formula_name, **kwargs)
+
+    assert repo.eval(formula_name, **kwargs) == expected
+    # again, from the cache
+    assert repo.eval(formula_name, **kwargs) == expected
+
+
+def test_eval_reserved_override(tmp_path):
+    repo = _load(tmp_path)
+    path = repo.eval('f_log', user='nick', name='a.log', disk=Disk.CONFIG)
+    assert path == '~/Box/Capstone_Uploads/13_Tech/config/logs/nick/a.log'
+
+    # the cached result without the override isn't reused
+    assert repo.eval('d_logs') == '~/Box/Capstone_Uploads/13_Tech/haymaker/logs'
+    assert repo.eval('d_logs', disk=Disk.CONFIG) == (
+        '~/Box/Capstone_Uploads/13_Tech/config/logs'
+    )
+
+
+def test_eval_missing_argument(tmp_path):
+    repo = _load(tmp_path)
+    with pytest.raises(FormulaArgumentError):
+        repo.eval('f_log', user='nick')
+    with pytest.raises(FormulaArgumentError):
+        repo.eval('f_log', user='|unknown|', name='a.log')
+    with pytest.raises(FormulaNotFoundError):
+        repo.eval('f_unknown')
+
+
+def test_eval_unclosed_variable(tmp_path):
+    with pytest.raises(FormulaEvaluationError):
+        _load(tmp_path, {'f_bad': '|drive|/|name'})
+
+    repo = _load(tmp_path)
+    with pytest.raises(FormulaEvaluationError):
+        repo.eval('f_log', user='|seq', name='a.log')
+
+
+@pytest.mark.parametrize('formulas', [
+    {'d_a': '|d_b|/a', 'd_b': '|d_a|/b'},
+    {'d_a': '/|d_a|'},
+    {'d_a': '|d_b|', 'd_b': '|d_c|', 'd_c': '|drive|/|d_a|'},
+    # formula names without their prefix are variables too
+    {'d_shot': '|drive|/|shot|'},
+])
+def test_cycle_detection(tmp_path, formulas):
+    with pytest.raises(FormulaCycleError):
+        _load(tmp_path, formulas)
+
+
+@pytest.mark.parametrize('formula_name, kwargs', CASES)
+def test_eval_many_matches_eval(tmp_path, formula_name, kwargs):
+    repo = _load(tmp_path)
+    expected = _reference_eval(repo, formula_name, **kwargs)
+
+    # as one row, as columns, and with everything shared
+    assert list(repo.eval_many(formula_name, [kwargs])) == [expected]
+    if kwargs:
+        columns = {key: [value] for key, value in kwargs.items()}
+        assert list(repo.eval_many(formula_name, columns)) == [expected]
+    assert list(repo.eval_many(formula_name, [{}], **kwargs)) == [expected]
+
+
+def test_eval_many_rows(tmp_path):
+    repo = _load(tmp_path)
+    rows = [{'user': f'user{i}', 'name': f'{i}.log'} for i in range(5)]
+    rows.append({'user': 'nick', 'name': 'a.log', 'disk': Disk.CONFIG})
+    rows.append({'user': '|seq|', 'seq': 's01', 'name': 'b.log'})
+
+    assert list(repo.eval_many('f_log', rows)) == [
+        _reference_eval(repo, 'f_log', **row) for row in rows
+    ]
+
+
+def test_eval_many_shared_kwargs(tmp_path):
+    repo = _load(tmp_path)
+    rows = [{'shot': f'{i:03}', 'version': '0001'} for i in range(3)]
+    shared = {'seq': 's01', 'ext': 'ma'}
+
+    assert list(repo.eval_many('f_shot_version', rows, **shared)) == [
+        _reference_eval(repo, 'f_shot_version', **shared, **row) for row in rows
+    ]
+
+
+def test_eval_many_rows_override_shared_kwargs(tmp_path):
+    repo = _load(tmp_path)
+    rows = [{'user': 'b', 'name': 'x'}, {'name': 'y'}]
+    expected = [
+        _reference_eval(repo, 'f_log', **{'user': 'a', **row}) for row in rows
+    ]
+
+    assert expected[0].endswith('/logs/b/x')
+    assert list(repo.eval_many('f_log', rows, user='a')) == expected
+    columns = {'user': ['b', 'a'], 'name': ['x', 'y']}
+    assert list(repo.eval_many('f_log', columns, user='a')) == expected
+
+
+def test_eval_many_shared_values_use_rows(tmp_path):
+    # a shared value whose variables come from each row
+    repo = _load(tmp_path)
+    rows = [{'seq': 's01', 'name': 'x'}, {'seq': 's02', 'name': 'y'}]
+
+    assert list(repo.eval_many('f_log', rows, user='|seq|')) == [
+        _reference_eval(repo, 'f_log', user='|seq|', **row) for row in rows
+    ]
+
+
+def test_eval_many_columns_missing(tmp_path):
+    repo = _load(tmp_path)
+    with pytest.raises(FormulaArgumentError):
+        list(repo.eval_many('f_log', {'user': ['a']}))
+
+
+@pytest.mark.parametrize('formula_name, kwargs', [
+    case for case in CASES
+    if not any(isinstance(value, (Disk, Drive)) or '|' in value
+               for value in case[1].values())
+    and not set(case[1]) & {'d_logs', 'd_shot_dir', 'f_log', 'logs'}
+])
+def test_match_round_trip(tmp_path, formula_name, kwargs):
+    repo = _load(tmp_path)
+    path = repo.eval(formula_name, **kwargs)
+    match = repo.match(path)
+
+    assert match is not None
+    name, variables = match
+    # another formula can produce the same path, it has to evaluate to it too
+    assert _reference_eval(repo, name, **variables) == path
+
+
+def test_startup_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(FormulaRepo, 'DIR_STARTUP_CACHE', str(tmp_path / 'cache'))
+    path = tmp_path / 'formulas.json'
+    path.write_text(json.dumps({'formulas': FORMULAS, 'formula_prefixes': ['d', 'f']}))
+
+    repo = FormulaRepo.load(str(path))
+    assert len(os.listdir(tmp_path / 'cache')) == 1
+    cached = FormulaRepo.load(str(path))
+    assert cached is not repo
+    assert cached.eval('f_log', user='nick', name='a.log') == repo.eval(
+        'f_log', user='nick', name='a.log'
+    )
+
+
+def test_startup_cache_unpicklable(tmp_path, monkeypatch):
+    monkeypatch.setattr(FormulaRepo, 'DIR_STARTUP_CACHE', str(tmp_path / 'cache'))
+    monkeypatch.setattr(FormulaRepo, '__getstate__', lambda self: lambda: None)
+    path = tmp_path / 'formulas.json'
+    path.write_text(json.dumps({'formulas': FORMULAS, 'formula_prefixes': ['d', 'f']}))
+
+    # loading works without the cache, and leaves no temp file behind
+    repo = FormulaRepo.load(str(path))
+    assert repo.eval('d_logs') == '~/Box/Capstone_Uploads/13_Tech/haymaker/logs'
+    assert not (tmp_path / 'cache').exists() or not os.listdir(tmp_path / 'cache')
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+#SETMODE 777
+
+#----------------------------------------------------------------------------------------#
+#------------------------------------------------------------------------------ HEADER --#
+
+"""
+:author:
+    Nick Maclean
+
+:synopsis:
+    Tests for the version retention plan (haymaker.utils.plan_version_retention), which
+    decides what apply_version_retention deletes.
+
+    python -m pytest tests
+"""
+
+#----------------------------------------------------------------------------------------#
+#----------------------------------------------------------------------------- IMPORTS --#
+
+# Built-In
+from datetime import date, datetime, time, timedelta
+import os
+
+# Third Party
+import pytest
+
+# Internal
+from haymaker import utils
+from haymaker.utils import (
+    apply_version_retention, plan_version_retention, RetentionPolicy,
+    VERSION_PUBLISHED_FILE, VERSION_STORE_DIR
+)
+
+#----------------------------------------------------------------------------------------#
+#--------------------------------------------------------------------------- FUNCTIONS --#
+
+
+@pytest.fixture(autouse=True)
+def no_log(monkeypatch):
+    # keep test runs out of the session logs
+    monkeypatch.setattr(utils, 'log', lambda *args, **kwargs: None)
+
+
+def _write(directory, name: str, day: date, data: str = None) -> str:
+    path = os.path.join(directory, name)
+    with open(path, 'w') as file:
+        file.write(data if data is not None else name)
+    _set_day(path, day)
+    return path
+
+
+def _set_day(path: str, day: date):
+    # midday, so the date is the same in any timezone offset the test runs in
+    stamp = datetime.combine(day, time(12)).timestamp()
+    os.utime(path, (stamp, stamp))
+
+
+def _names(plan) -> list:
+    return sorted(os.path.basename(path) for path in plan.delete)
+
+
+def test_keep_last(tmp_path):
+    old = date.today() - timedelta(days=100)
+    for version in range(1, 9):
+        _write(tmp_path, f'Warehouse.{version:04}.ma', old)
+
+    policy = RetentionPolicy(keep_last=3, keep_daily=0, keep_weekly=0)
+    plan = plan_version_retention(str(tmp_path), policy)
+
+    assert _names(plan) == [f'Warehouse.{version:04}.ma' for version in range(1, 6)]
+    assert plan.kept == 3
+
+
+def test_keep_last_always_keeps_latest(tmp_path):
+    old = date.today() - timedelta(days=100)
+    _write(tmp_path, 'Warehouse.0001.ma', old)
+    _write(tmp_path, 'Warehouse.0002.ma', old)
+
+    policy = RetentionPolicy(keep_last=0, keep_daily=0, keep_weekly=0)
+    plan = plan_version_retention(str(tmp_path), policy)
+
+    assert _names(plan) == ['Warehouse.0001.ma']
+
+
+def test_keep_daily(tmp_path):
+    # three versions on each of the last three days, the newest of each day is kept
+    today = date.today()
+    version = 0
+    for days in (2, 1, 0):
+        for _ in range(3):
+            version += 1
+            _write(tmp_path, f'Warehouse.{version:04}.ma', today - timedelta(days=days))
+
+    policy = RetentionPolicy(keep_last=1, keep_daily=7, keep_weekly=0)
+    plan = plan_version_retention(str(tmp_path), policy)
+
+    assert _names(plan) == [
+        'Warehouse.0001.ma', 'Warehouse.0002.ma', 'Warehouse.0004.ma',
+        'Warehouse.0005.ma', 'Warehouse.0007.ma', 'Warehouse.0008.ma',
+    ]
+    assert plan.kept == 3
+
+
+def test_keep_daily_ignores_old_days(tmp_path):
+    today = date.today()
+    _write(tmp_path, 'Warehouse.0001.ma', today - timedelta(days=10))
+    _write(tmp_path, 'Warehouse.0002.ma', today)
+
+    policy = RetentionPolicy(keep_last=1, keep_daily=7, keep_weekly=0)
+    plan = plan_version_retention(str(tmp_path), policy)
+
+    assert _names(plan) == ['Warehouse.0001.ma']
+
+
+def test_keep_weekly(tmp_path):
+    today = date.today()
+    monday = today - timedelta(days=today.weekday())
+    last_monday = monday - timedelta(days=7)
+    _write(tmp_path, 'Warehouse.0001.ma', today - timedelta(days=30))
+    _write(tmp_path, 'Warehouse.0002.ma', last_monday)
+    _write(tmp_path, 'Warehouse.0003.ma', last_monday + timedelta(days=1))
+    _write(tmp_path, 'Warehouse.0004.ma', today)
+
+    policy = RetentionPolicy(keep_last=1, keep_daily=0, keep_weekly=2)
+    plan = plan_version_retention(str(tmp_path), policy)
+
+    # the newest of last week is kept, the older one and the month old one aren't
+    assert _names(plan) == ['Warehouse.0001.ma', 'Warehouse.0002.ma']
+
+
+def test_keep_published(tmp_path):
+    old = date.today() - timedelta(days=100)
+    for version in range(1, 4):
+        _write(tmp_path, f'Warehouse.{version:04}.ma', old)
+    with open(tmp_path / VERSION_PUBLISHED_FILE, 'w') as file:
+        file.write('Warehouse.0001.ma\n')
+
+    policy = RetentionPolicy(keep_last=1, keep_daily=0, keep_weekly=0)
+    assert _names(plan_version_retention(str(tmp_path), policy)) == [
+        'Warehouse.0002.ma'
+    ]
+
+    policy.keep_published = False
+    assert _names(plan_version_retention(str(tmp_path), policy)) == [
+        'Warehouse.0001.ma', 'Warehouse.0002.ma'
+    ]
+
+
+def test_files_kept_separately(tmp_path):
+    # each file (name and extension) keeps its own versions
+    old = date.today() - timedelta(days=100)
+    for name in ('Warehouse', 'Barn'):
+        for ext in ('ma', 'mb'):
+            _write(tmp_path, f'{name}.0001.{ext}', old)
+            _write(tmp_path, f'{name}.0002.{ext}', old)
+
+    policy = RetentionPolicy(keep_last=1, keep_daily=0, keep_weekly=0)
+    plan = plan_version_retention(str(tmp_path), policy)
+
+    assert _names(plan) == [
+        'Barn.0001.ma', 'Barn.0001.mb', 'Warehouse.0001.ma', 'Warehouse.0001.mb'
+    ]
+
+
+def test_only_scene_extensions_by_default(tmp_path):
+    # frames and UDIM tiles are named like versions
+    old = date.today() - timedelta(days=100)
+    for frame in range(1, 6):
+        _write(tmp_path, f'shot010.{frame:04}.exr', old)
+    for tile in (1001, 1002, 1003):
+        _write(tmp_path, f'body_BaseColor.{tile}.png', old)
+    _write(tmp_path, 'Warehouse.0001.ma', old)
+    _write(tmp_path, 'Warehouse.0002.ma', old)
+
+    policy = RetentionPolicy(keep_last=1, keep_daily=0, keep_weekly=0)
+    assert _names(plan_version_retention(str(tmp_path), policy)) == [
+        'Warehouse.0001.ma'
+    ]
+    assert _names(plan_version_retention(str(tmp_path), policy, exts=['exr'])) == [
+        f'shot010.{frame:04}.exr' for frame in range(1, 5)
+    ]
+
+
+def test_subdirectories(tmp_path):
+    old = date.today() - timedelta(days=100)
+    directory = tmp_path / 'Props' / 'Barn'
+    directory.mkdir(parents=True)
+    _write(directory, 'Barn.0001.ma', old)
+    _write(directory, 'Barn.0002.ma', old)
+
+    policy = RetentionPolicy(keep_last=1, keep_daily=0, keep_weekly=0)
+    plan = plan_version_retention(str(tmp_path), policy)
+
+    assert plan.delete == [str(directory / 'Barn.0001.ma').replace('\\', '/')]
+
+
+def _store(directory, data: str, names: list, day: date) -> str:
+    # versions sharing one stored file, like clone_file(dedupe=True) leaves them
+    store = directory / VERSION_STORE_DIR
+    store.mkdir(exist_ok=True)
+    path_object = _write(store, f'{len(data)}_{names[0]}', day, data)
+    for name in names:
+        os.link(path_object, directory / name)
+    return path_object
+
+
+def test_store_deleted_with_last_version(tmp_path):
+    old = date.today() - timedelta(days=100)
+    data = 'x' * 1000
+    path_object = _store(tmp_path, data, ['Warehouse.0001.ma', 'Warehouse.0002.ma'], old)
+    _write(tmp_path, 'Warehouse.0003.ma', old, 'newer')
+
+    policy = RetentionPolicy(keep_last=1, keep_daily=0, keep_weekly=0)
+    plan = plan_version_retention(str(tmp_path), policy)
+
+    assert _names(plan) == sorted([
+        os.path.basename(path_object), 'Warehouse.0001.ma', 'Warehouse.0002.ma'
+    ])
+    assert plan.bytes_reclaimed == len(data)
+
+
+def test_store_kept_while_linked(tmp_path):
+    old = date.today() - timedelta(days=100)
+    data = 'x' * 1000
+    _store(tmp_path, data, ['Warehouse.0001.ma', 'Warehouse.0002.ma'], old)
+
+    policy = RetentionPolicy(keep_last=1, keep_daily=0, keep_weekly=0)
+    plan = plan_version_retention(str(tmp_path), policy)
+
+    # the kept version still links to the data, so nothing is freed
+    assert _names(plan) == ['Warehouse.0001.ma']
+    assert plan.bytes_reclaimed == 0
+
+
+def test_bytes_reclaimed(tmp_path):
+    old = date.today() - timedelta(days=100)
+    _write(tmp_path, 'Warehouse.0001.ma', old, 'a' * 100)
+    _write(tmp_path, 'Warehouse.0002.ma', old, 'b' * 200)
+    _write(tmp_path, 'Warehouse.0003.ma', old, 'c' * 400)
+
+    policy = RetentionPolicy(keep_last=1, keep_daily=0, keep_weekly=0)
+    plan = plan_version_retention(str(tmp_path), policy)
+
+    assert plan.bytes_reclaimed == 300
+
+
+def test_apply_dry_run(tmp_path):
+    old = date.today() - timedelta(days=100)
+    _write(tmp_path, 'Warehouse.0001.ma', old)
+    _write(tmp_path, 'Warehouse.0002.ma', old)
+
+    policy = RetentionPolicy(keep_last=1, keep_daily=0, keep_weekly=0)
+    plan = apply_version_retention(str(tmp_path), policy)
+
+    assert _names(plan) == ['Warehouse.0001.ma']
+    assert sorted(os.listdir(tmp_path)) == ['Warehouse.0001.ma', 'Warehouse.0002.ma']
+
+
+def test_apply(tmp_path):
+    old = date.today() - timedelta(days=100)
+    path_object = _store(tmp_path, 'x' * 10, ['Warehouse.0001.ma'], old)
+    _write(tmp_path, 'Warehouse.0002.ma', old)
+    _write(tmp_path, 'shot010.0001.exr', old)
+
+    policy = RetentionPolicy(keep_last=1, keep_daily=0, keep_weekly=0)
+    apply_version_retention(str(tmp_path), policy, dry_run=False)
+
+    assert sorted(os.listdir(tmp_path)) == [
+        VERSION_STORE_DIR, 'Warehouse.0002.ma', 'shot010.0001.exr'
+    ]
+    assert not os.path.exists(path_object)
+    assert utils.get_latest_version(str(tmp_path / 'Warehouse.0002.ma')) == str(
+        tmp_path / 'Warehouse.0002.ma'
+    ).replace('\\', '/')
+
+
+def test_mark_active_published(tmp_path):
+    # the active file may differ from the latest version, so it's versioned before marking
+    old = date.today() - timedelta(days=100)
+    _write(tmp_path, 'Warehouse.0001.ma', old)
+    path_active = _write(tmp_path, 'Warehouse.active.ma', old, 'published')
+
+    path_version = utils.mark_version_published(path_active)
+
+    assert os.path.basename(path_version) == 'Warehouse.0002.ma'
+    with open(path_version) as file:
+        assert file.read() == 'published'
+    with open(tmp_path / VERSION_PUBLISHED_FILE) as file:
+        assert file.read() == 'Warehouse.0002.ma\n'